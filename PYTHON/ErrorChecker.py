@@ -5,14 +5,60 @@ Created on Thu Apr 11 12:07:35 2019
 @author: Andrew
 """
 import numpy as np
+import hashlib
 from Constants import Constants
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 OrganTuple = namedtuple('OrganTuple', ['organ', 'dose'])
+
+def pairwise_l1(x, y = None, block_size = 64):
+    #sum of absolute differences between every pair of rows in x and y.
+    #done in blocks of rows so the temporary (block_size x len(y) x n_features) array stays small
+    x = np.asarray(x)
+    y = x if y is None else np.asarray(y)
+    distances = np.zeros((x.shape[0], y.shape[0]))
+    for start in range(0, x.shape[0], block_size):
+        x_block = x[start: start + block_size]
+        distances[start: start + block_size] = np.abs(x_block[:, np.newaxis, :] - y[np.newaxis, :, :]).sum(axis = 2)
+    return distances
+
+def array_key(x, *args):
+    #hashable key for an array based on its contents, used for caching results
+    x = np.ascontiguousarray(x)
+    return (hashlib.sha1(x.tobytes()).hexdigest(), x.shape, x.dtype.str) + tuple(args)
+
+#last few results of dose_error_matrix, keyed on the dose array contents
+dose_error_cache = OrderedDict()
+dose_error_cache_size = 8
+
+def dose_error_matrix(doses, dtype = 'float64', normalize = True, block_size = 64):
+    #pairwise dose error between patients: sum(|d1 - d2|)/sum(d1) for p1 < p2, copied to the lower triangle.
+    #normalize = False gives the plain l1 distance. dtype = 'float32' halves the memory for large cohorts.
+    #returns a copy, so callers can change it without affecting the cache
+    key = array_key(doses, np.dtype(dtype).str, normalize)
+    if key in dose_error_cache:
+        dose_error_cache.move_to_end(key)
+        return np.copy(dose_error_cache[key])
+    doses = np.asarray(doses)
+    error_matrix = pairwise_l1(doses, block_size = block_size)
+    if normalize:
+        error_matrix /= np.sum(doses, axis = 1).reshape(-1,1)
+    error_matrix = np.triu(error_matrix, 1)
+    error_matrix += error_matrix.transpose()
+    error_matrix = error_matrix.astype(dtype)
+    dose_error_cache[key] = error_matrix
+    if len(dose_error_cache) > dose_error_cache_size:
+        dose_error_cache.popitem(last = False)
+    return np.copy(error_matrix)
+
 class ErrorChecker():
     #class that takes the patientset and checks that the data for each patient meets some conditions
     #used to get a list of the bad patients that the patientset class uses to remove values
 
+    #results of get_data_outliers for the last few dose matrices, since the estimators call it a lot on the same data
+    outlier_cache = OrderedDict()
+    outlier_cache_size = 8
+
     def __init__(self, remove_outliers = False, remove_missing_gtvp = False):
         #saves locations of certain keys organs.
         #eyes are exempt from needing to have non-zero values, since they are basically 0 anyway
@@ -99,20 +145,27 @@ class ErrorChecker():
 #        print(pset)
         return pset
 
-    def get_data_outliers(self, doses, dose_match_threshold = .2, min_matches = 1):
-        outliers = set([])
+    def get_data_outliers(self, doses, dose_match_threshold = .2, min_matches = 1, block_size = 64):
+        #patients with fewer than min_matches later patients that have a dose difference below the threshold
+        #(as a fraction of their own total dose)
+        key = array_key(doses, dose_match_threshold, min_matches)
+        if key in ErrorChecker.outlier_cache:
+            ErrorChecker.outlier_cache.move_to_end(key)
+            return set(ErrorChecker.outlier_cache[key])
+        doses = np.asarray(doses)
         n_patients = doses.shape[0]
-        for p1 in range(n_patients):
-            x1 = doses[p1,:]
-            num_matches = 0
-            for p2 in range(p1+ 1, n_patients):
-                x2 = doses[p2,:]
-                dose_diff = np.sum(np.abs(x1 - x2))/np.sum(x1)
-                if dose_diff < dose_match_threshold:
-                    num_matches += 1
-            if num_matches < min_matches:
-                outliers.add(p1)
+        num_matches = np.zeros((n_patients,)).astype('int64')
+        for start in range(0, n_patients, block_size):
+            x1 = doses[start: start + block_size]
+            dose_diff = pairwise_l1(x1, doses, block_size)/np.sum(x1, axis = 1).reshape(-1,1)
+            #only count patients after p1, like comparing p1 to range(p1 + 1, n_patients)
+            later = np.arange(n_patients).reshape(1,-1) > np.arange(start, start + x1.shape[0]).reshape(-1,1)
+            num_matches[start: start + block_size] = np.sum((dose_diff < dose_match_threshold) & later, axis = 1)
+        outliers = set(np.argwhere(num_matches < min_matches).ravel().tolist())
 #        print('outliers', outliers)
+        ErrorChecker.outlier_cache[key] = frozenset(outliers)
+        if len(ErrorChecker.outlier_cache) > ErrorChecker.outlier_cache_size:
+            ErrorChecker.outlier_cache.popitem(last = False)
         return outliers
 
     def get_clean_subset(self, db):
@@ -7,6 +7,7 @@ Created on Wed Jun 19 16:11:27 2019
 import numpy as np
 from Constants import Constants
 from Models import *
+from ErrorChecker import dose_error_matrix
 from scipy.spatial.distance import directed_hausdorff
 from scipy.spatial import ConvexHull, procrustes
 import copy
@@ -110,10 +111,53 @@ def augment_mirrored(matrix, organ_list = None):
 
 #full similarity measures
 
-def get_sim(db, similarity_function):
+def get_batch_metric(similarity_function):
+    #maps a patient-wise comparison function to the name used by pairwise_sim
+    #returns None if there isn't a vectorized version
+    if isinstance(similarity_function, str):
+        return similarity_function
+    batch_metrics = {jaccard_distance: 'jaccard',
+                     mse: 'mse',
+                     cosine_similarity: 'cosine'}
+    try:
+        return batch_metrics.get(similarity_function, None)
+    except TypeError:
+        return None
+
+def pairwise_sim(x, y = None, metric = 'jaccard', block_size = 512):
+    #vectorized version of jaccard_distance, mse, and cosine_similarity for every pair of rows in x and y
+    #uses x.dot(y) for all the pairs in a block of rows at once, so memory is ~block_size*len(y)
+    x = np.asarray(x, dtype = 'float64')
+    y = x if y is None else np.asarray(y, dtype = 'float64')
+    y_norms = np.einsum('ij,ij->i', y, y)
+    similarity = np.zeros((x.shape[0], y.shape[0]))
+    for start in range(0, x.shape[0], block_size):
+        x_block = x[start: start + block_size]
+        x_norms = np.einsum('ij,ij->i', x_block, x_block).reshape(-1,1)
+        dots = np.dot(x_block, y.T)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            if metric == 'jaccard':
+                denominator = x_norms + y_norms - dots
+                block = np.where((dots == 0) | (denominator == 0), 0, dots/denominator)
+            elif metric == 'mse':
+                block = np.maximum(x_norms + y_norms - 2*dots, 0)/x.shape[1]
+            elif metric == 'cosine':
+                denominator = np.sqrt(x_norms)*np.sqrt(y_norms)
+                block = np.where(denominator == 0, 0, dots/denominator)
+            else:
+                raise ValueError('unknown metric for pairwise_sim: ' + str(metric))
+        similarity[start: start + block_size] = block
+    return similarity
+
+def get_sim(db, similarity_function, features = None, block_size = 512):
     #takes a function and the database and returns a similarity or distance matrix
     #assumes it's symmetric, so it only compares once
+    #if features (n_patients x n_features) is given and the function has a vectorized version, uses pairwise_sim
     num_patients = db.get_num_patients()
+    metric = get_batch_metric(similarity_function)
+    if features is not None and metric is not None:
+        similarity_matrix = np.triu(pairwise_sim(features, metric = metric, block_size = block_size), 1)
+        return similarity_matrix + similarity_matrix.transpose()
     similarity_matrix = np.zeros((num_patients, num_patients))
     for p1 in range(num_patients):
         for p2 in range(p1 + 1, num_patients):
@@ -121,20 +165,28 @@ def get_sim(db, similarity_function):
     similarity_matrix += similarity_matrix.transpose()
     return similarity_matrix
 
-def augmented_sim(feature, similarity_function, organ_list = None):
+def augmented_sim(feature, similarity_function, organ_list = None, block_size = 512):
     #like get sim but needs to explicity give the data matrix (e.g. tumor distances)
     #so it can augment the data with mirrored things
     augmented_features = augment_mirrored(feature, organ_list)
     n_patients = feature.shape[0]
     n_features = augmented_features.shape[0]
-    similarity_matrix = np.zeros((n_features, n_features))
-    for p1 in range(similarity_matrix.shape[0]):
-        data1 = augmented_features[p1]
-        for p2 in range(similarity_matrix.shape[1]):
-            if (p1%n_patients) == (p2%n_patients):
-                continue
-            data2 = augmented_features[p2]
-            similarity_matrix[p1,p2] = similarity_function(data1, data2)
+    metric = get_batch_metric(similarity_function)
+    if metric is not None:
+        similarity_matrix = pairwise_sim(augmented_features, metric = metric, block_size = block_size)
+        #patients aren't compared to themselves or their mirrored version
+        args = np.arange(n_features)
+        similarity_matrix[args, args] = 0
+        similarity_matrix[args, (args + n_patients) % n_features] = 0
+    else:
+        similarity_matrix = np.zeros((n_features, n_features))
+        for p1 in range(similarity_matrix.shape[0]):
+            data1 = augmented_features[p1]
+            for p2 in range(similarity_matrix.shape[1]):
+                if (p1%n_patients) == (p2%n_patients):
+                    continue
+                data2 = augmented_features[p2]
+                similarity_matrix[p1,p2] = similarity_function(data1, data2)
     similarity_matrix = minmax_scale(similarity_matrix)
     for p in range(n_patients):
         similarity_matrix[p,p] = 0
@@ -181,6 +233,12 @@ def jaccard_distance(x, y, w = None, v = None):
         return 0
     return numerator/denominator
 
+def cosine_similarity(x, y, w = None, v = None):
+    denominator = np.linalg.norm(x)*np.linalg.norm(y)
+    if denominator == 0:
+        return 0
+    return x.dot(y)/denominator
+
 def local_ssim(x,y,v = None, w = None):
     c1 = .000001
     c2  = .000001
@@ -200,6 +258,36 @@ def local_ssim(x,y,v = None, w = None):
         print('error, zero denomiator in ssim function')
         return 0
 
+def batch_local_ssim(x, v = None, counts = None):
+    #vectorized local_ssim (with the volume term if v is given) between every pair of rows of x
+    #x can be (n_patients x n_values) or a stack of those (n_sets x n_patients x n_values).
+    #if counts is given only the first counts[i] values of set i are used and the rest is treated as padding
+    #returns (n_patients x n_patients) or (n_sets x n_patients x n_patients)
+    c1 = .000001
+    c2  = .000001
+    x = np.asarray(x, dtype = 'float64')
+    if counts is None:
+        counts = np.full(x.shape[:-2], x.shape[-1])
+    n = np.asarray(counts, dtype = 'float64')[..., np.newaxis]
+    mask = np.arange(x.shape[-1]) < n[..., np.newaxis]
+    def masked_mean(values):
+        return np.where(mask, values, 0).sum(axis = -1)/n
+    mean_x = masked_mean(x)
+    centered = np.where(mask, x - mean_x[..., np.newaxis], 0)
+    variance = (centered**2).sum(axis = -1)/n
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        #same normalization as np.cov
+        covariance = np.matmul(centered, np.swapaxes(centered, -1, -2))/(n[..., np.newaxis] - 1)
+        outer = lambda a, b: a[..., :, np.newaxis]*b[..., np.newaxis, :]
+        total = lambda a: a[..., :, np.newaxis] + a[..., np.newaxis, :]
+        numerator = (2*outer(mean_x, mean_x) + c1) * (2*covariance + c2)
+        denominator = (total(mean_x**2) + c1)*(total(variance) + c2)
+        if v is not None:
+            mean_v = masked_mean(np.asarray(v, dtype = 'float64'))
+            numerator *= (2*outer(mean_v, mean_v) + c1)
+            denominator *= (total(mean_v**2) + c1)
+        return np.where(denominator > 0, numerator/denominator, 0)
+
 def harmonic_sum(values):
     return 1/np.sum([1/v for v in values])
 
@@ -428,16 +516,24 @@ def get_max_tumor_ssim(patient1, patient2):
     return max_similarity
 
 def dose_similarity(dose_predictions, distance_metric = None, similarity = True):
+    #distance_metric can be a function of two dose vectors, or 'l1'.
+    #mse (the default) and l1 are done for all pairs at once
     if distance_metric is None:
         distance_metric = mse
     n_patients = dose_predictions.shape[0]
-    dists = np.zeros((n_patients, n_patients))
-    for p1 in range(n_patients):
-        d1 = dose_predictions[p1]
-        for p2 in range(p1+1, n_patients):
-            d2 = dose_predictions[p2]
-            dists[p1,p2] = distance_metric(d1, d2)
-    dists += dists.transpose()
+    if isinstance(distance_metric, str) and distance_metric == 'l1':
+        dists = dose_error_matrix(dose_predictions, normalize = False)
+    elif get_batch_metric(distance_metric) == 'mse':
+        dists = np.triu(pairwise_sim(dose_predictions, metric = 'mse'), 1)
+        dists += dists.transpose()
+    else:
+        dists = np.zeros((n_patients, n_patients))
+        for p1 in range(n_patients):
+            d1 = dose_predictions[p1]
+            for p2 in range(p1+1, n_patients):
+                d2 = dose_predictions[p2]
+                dists[p1,p2] = distance_metric(d1, d2)
+        dists += dists.transpose()
     if similarity:
         similarity = dist_to_sim(dists)
         return similarity
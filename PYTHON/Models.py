@@ -8,14 +8,17 @@ from numpy.random import seed
 seed(1)
 import numpy as np
 from Constants import Constants
-from ErrorChecker import ErrorChecker
+from ErrorChecker import ErrorChecker, dose_error_matrix
 import Metrics
+from NeighborGraph import NeighborGraph
 from scipy.optimize import minimize
 from abc import ABC, abstractmethod
 from sklearn.cluster import KMeans, AgglomerativeClustering
-from copy import copy
+from copy import copy, deepcopy
 from sklearn.preprocessing import quantile_transform
 from sklearn.tree import DecisionTreeClassifier
+from sklearn.base import clone
+from joblib import Parallel, delayed
 
 
 
@@ -49,27 +52,140 @@ class Estimator(ABC):
         percent_error = self.get_error(predicted_doses, data.doses)
         return(percent_error)
 
+    def get_all_num_matches(self, scores, clusters):
+        #get_num_matches for every row of a score matrix
+        n_patients = scores.shape[0]
+        if self.match_type == 'threshold':
+            good_matches = np.sum(scores > self.match_threshold, axis = 1)
+            return np.maximum(good_matches, self.min_matches)
+        elif self.match_type == 'clusters':
+            cluster_values, cluster_counts = np.unique(clusters, return_counts = True)
+            num_cluster_values = cluster_counts[np.searchsorted(cluster_values, clusters)]
+            return np.maximum((np.sqrt(num_cluster_values) + 1).astype('int32'), self.min_matches)
+        return np.full((n_patients,), self.min_matches)
+
+    def get_top_args(self, scores, k):
+        #the k highest scores in each row, ordered by score and then by index like a stable sort on -scores.
+        #k can be a number or one per row, rows with fewer than max(k) are padded with 0 at the end.
+        #only the scores tied with each row's own k-th score are broken by index, so no row is fully sorted
+        n_rows, n_cols = scores.shape
+        k = np.minimum(np.broadcast_to(np.asarray(k, dtype = 'int64'), (n_rows,)), n_cols)
+        k = np.maximum(k, 0)
+        max_k = int(k.max()) if n_rows > 0 else 0
+        if max_k <= 0:
+            return np.zeros((n_rows, 0)).astype('int64')
+        top_scores = -np.sort(np.partition(-scores, max_k - 1, axis = 1)[:, :max_k], axis = 1)
+        cutoff = top_scores[np.arange(n_rows), np.maximum(k - 1, 0)].reshape(-1,1)
+        above = scores > cutoff
+        tied = scores == cutoff
+        #the first (by index) of the tied scores fill up the rest of the k
+        num_tied = (k - above.sum(axis = 1)).reshape(-1,1)
+        selected = (above | (tied & (np.cumsum(tied, axis = 1) <= num_tied))) & (k > 0).reshape(-1,1)
+        rows, cols = np.nonzero(selected)
+        positions = np.arange(len(rows)) - np.repeat(np.cumsum(k) - k, k)
+        top_args = np.zeros((n_rows, max_k)).astype('int64')
+        top_args[rows, positions] = cols
+        is_padding = np.ones((n_rows, max_k)).astype('bool')
+        is_padding[rows, positions] = False
+        top_scores = np.zeros((n_rows, max_k))
+        top_scores[rows, positions] = scores[rows, cols]
+        order = np.lexsort((top_args, -top_scores, is_padding), axis = 1)
+        return np.take_along_axis(top_args, order, axis = 1)
+
+    def get_batch_predictions(self, dose_matrix, scores, num_matches, weights = None, block_size = 256):
+        #weighted average of the doses of the top num_matches[p] scores in each row.
+        #weights (the scores by default) are used for the average, rows without a positive weight get the mean dose.
+        #only the top max(num_matches) columns are selected (argpartition) and gathered, in blocks of rows
+        #so the (rows x k x organs) array stays small
+        if weights is None:
+            weights = scores
+        n_rows = scores.shape[0]
+        num_matches = np.minimum(num_matches, scores.shape[1])
+        predicted_doses = np.tile(dose_matrix.mean(axis = 0), (n_rows, 1))
+        for start in range(0, n_rows, block_size):
+            stop = min([start + block_size, n_rows])
+            block_matches = num_matches[start:stop]
+            match_args = self.get_top_args(scores[start:stop], block_matches)
+            in_matches = np.arange(match_args.shape[1]) < block_matches.reshape(-1,1)
+            match_weights = np.where(in_matches, np.take_along_axis(weights[start:stop], match_args, axis = 1), 0)
+            weight_sums = match_weights.sum(axis = 1)
+            has_matches = np.argwhere(weight_sums > 0).ravel()
+            predicted_doses[start + has_matches] = np.einsum('qk,qkd->qd', match_weights[has_matches],
+                           dose_matrix[match_args[has_matches]])/weight_sums[has_matches].reshape(-1,1)
+        return predicted_doses
+
 class SupervisedModel(ABC):
+    #storage for the pairwise feature table, float32 and/or a .npy file to memory map can be used for big cohorts
+    feature_dtype = 'float64'
+    feature_file = None
 
     @abstractmethod
     def get_true_matches(self, data):
         pass
 
-    def get_match_error(self, data):
+    @staticmethod
+    def fit_loo_model(model, features, labels, train_rows, patient_args, probability = True):
+        #staticmethod so it can be sent to a worker process, returns the match probabilites
+        #(or regression output) for one patient
+        model.fit(features[train_rows], labels[train_rows])
+        if probability:
+            return model.predict_proba(features[patient_args])[:,1]
+        return model.predict(features[patient_args])
+
+    def get_pair_features(self, similarities, true_similarity, num_patients, num_targets = None,
+                          leading = None, trailing = None):
+        #builds the pairwise training table: one row for each patient p1 < num_patients and target p2 < num_targets,
+        #skipping p2 == p1 (and its mirror p1 + num_patients for augmented matrices), in row-major order.
+        #columns are leading[p2], similarity[p1, p2] for each similarity matrix, then trailing[p2]
+        if num_targets is None:
+            num_targets = num_patients
+        keep = np.ones((num_patients, num_targets)).astype('bool')
+        for offset in range(0, num_targets, num_patients):
+            keep[np.arange(num_patients), np.arange(num_patients) + offset] = False
+        columns = [similarity[:num_patients, :num_targets] for similarity in similarities]
+        if leading is not None:
+            columns.insert(0, np.broadcast_to(leading, keep.shape))
+        if trailing is not None:
+            columns.append(np.broadcast_to(trailing, keep.shape))
+        n_rows = int(keep.sum())
+        if self.feature_file is None:
+            x = np.empty((n_rows, len(columns)), dtype = self.feature_dtype)
+        else:
+            x = np.lib.format.open_memmap(self.feature_file, mode = 'w+',
+                                          dtype = self.feature_dtype,
+                                          shape = (n_rows, len(columns)))
+        for c, column in enumerate(columns):
+            x[:, c] = column[keep]
+        y = true_similarity[:num_patients, :num_targets][keep]
+        positions = np.argwhere(keep)
+        return [x, y, positions]
+
+    def normalize_features(self, x, block_size = 65536):
+        #minmax scales each column of the feature table in place, a block of rows at a time,
+        #so a float32 or memmapped table isn't copied into a float64 array
+        x_min = np.full((x.shape[1],), np.inf)
+        x_max = np.full((x.shape[1],), -np.inf)
+        for start in range(0, x.shape[0], block_size):
+            block = x[start: start + block_size]
+            x_min = np.minimum(x_min, block.min(axis = 0))
+            x_max = np.maximum(x_max, block.max(axis = 0))
+        x_range = x_max - x_min
+        for start in range(0, x.shape[0], block_size):
+            block = x[start: start + block_size]
+            block -= x_min.astype(x.dtype)
+            block /= x_range.astype(x.dtype)
+        if isinstance(x, np.memmap):
+            x.flush()
+        return x
+
+    def get_match_error(self, data, dtype = 'float64'):
         #get error in between patient dose distrubtions
         #data can be the dose matrix or a patientset
         if isinstance(data, np.ndarray):
             doses = data
         else:
             doses = data.doses
-        n_patients = doses.shape[0]
-        error_matrix = np.zeros((n_patients, n_patients))
-        for p1 in range(n_patients):
-            for p2 in range(p1 + 1, n_patients):
-                dose_difference = np.abs(doses[p1,:] - doses[p2, :])
-                error_matrix[p1, p2] = np.sum(dose_difference)/np.sum(doses[p1, :])
-        error_matrix += error_matrix.transpose()
-        return error_matrix
+        return dose_error_matrix(doses, dtype = dtype)
 
 class SymmetryAugmentedModel(Estimator):
 
@@ -89,34 +205,48 @@ class SymmetryAugmentedModel(Estimator):
         return np.mean(scores)
 
     def predict_doses(self, similarity, data):
+        flipped_doses = data.doses[:, Metrics.get_flip_args()]
+        scores, is_flipped = self.get_patient_similarities(data)
+        scores[np.arange(scores.shape[0]), np.arange(scores.shape[0])] = -np.inf
+        num_matches = self.get_all_num_matches(scores, data.classes)
+        match_args = self.get_top_args(scores, min([num_matches.max(), scores.shape[1] - 1]))
+        #weights of the matches for each patient, split by if the match uses the mirrored doses
+        rows = np.arange(scores.shape[0]).reshape(-1,1)
+        in_matches = np.arange(match_args.shape[1]) < num_matches.reshape(-1,1)
+        weights = np.zeros(scores.shape)
+        weights[rows, match_args] = np.where(in_matches, scores[rows, match_args], 0)
+        flipped_weights = np.where(is_flipped, weights, 0)
+        normal_weights = np.where(is_flipped, 0, weights)
+        total_weights = weights.sum(axis = 1)
+        for p1 in np.argwhere(total_weights <= 0).ravel():
+            print(scores[p1, match_args[p1, :num_matches[p1]]], p1, np.sort(scores[p1])[::-1])
+        dose_predictions = (np.dot(normal_weights, data.doses)
+                            + np.dot(flipped_weights, flipped_doses))/total_weights.reshape(-1,1)
+        return(dose_predictions)
+
+    def get_patient_similarities(self, data):
+        #same as get_patient_similarity for every pair at once. returns the (n x n) scores,
+        #and a mask of where the mirrored patient was the better match (ties go to the mirrored one)
         flip_args = Metrics.get_flip_args()
         adjacency = TJaccardModel().get_adjacency_lists(data.organ_distances,
                                  np.arange(Constants.num_organs))
         normal_distances = data.tumor_distances
         flipped_distances = data.tumor_distances[:, flip_args]
-        flipped_doses = data.doses[:, flip_args]
-        dose_predictions = np.zeros((data.get_num_patients(),
-                                     Constants.num_organs))
-        for p1 in range(data.get_num_patients()):
-            matches = []
-            for p2 in range(0, data.get_num_patients()):
-                if p1 == p2:
-                    continue
-                match = self.get_patient_similarity(p1, p2,
-                                                 normal_distances,
-                                                 flipped_distances,
-                                                 data.doses,
-                                                 flipped_doses,
-                                                 adjacency)
-                matches.append(match)
-            matches = sorted(matches, key = lambda x: -x[0])
-            n_matches = self.get_num_matches(p1, matches, data.classes)
-            prediction = np.array([x[1] for x in matches[0:n_matches]])
-            weights = np.array([x[0] for x in matches[0:n_matches]]).reshape(-1,1)
-            if weights.mean() <= 0:
-                print(weights, p1, [x[0] for x in matches])
-            dose_predictions[p1,:] = np.mean(prediction*weights, axis = 0)/np.mean(weights)
-        return(dose_predictions)
+        base_similarity = np.zeros((normal_distances.shape[0], normal_distances.shape[0]))
+        flipped_similarity = np.zeros(base_similarity.shape)
+        for organ_set in adjacency:
+            base_similarity += Metrics.pairwise_sim(normal_distances[:, organ_set],
+                                                    normal_distances[:, organ_set])
+            flipped_similarity += Metrics.pairwise_sim(normal_distances[:, organ_set],
+                                                       flipped_distances[:, organ_set])
+        base_similarity /= len(adjacency)
+        flipped_similarity /= len(adjacency)
+        #tsim gives 0 for patients with a missing (infinite) distance
+        missing = np.sum(normal_distances, axis = 1) == np.inf
+        base_similarity[:, missing] = 0
+        flipped_similarity[:, missing] = 0
+        is_flipped = ~(base_similarity > flipped_similarity)
+        return np.where(is_flipped, flipped_similarity, base_similarity), is_flipped
 
     def get_num_matches(self, p, matches, clusters):
         #for later better use probs
@@ -131,28 +261,11 @@ class SymmetryAugmentedModel(Estimator):
         return matches
 
     def get_matches(self, similarity_matrix, data):
-        flip_args = Metrics.get_flip_args()
-        adjacency = TJaccardModel().get_adjacency_lists(data.organ_distances,
-                                 np.arange(Constants.num_organs))
-        normal_distances = data.tumor_distances
-        flipped_distances = data.tumor_distances[:, flip_args]
-        flipped_doses = data.doses[:, flip_args]
-        all_matches = []
-        for p1 in range(data.get_num_patients()):
-            matches = []
-            for p2 in range(0, data.get_num_patients()):
-                match = self.get_patient_similarity(p1, p2,
-                                                 normal_distances,
-                                                 flipped_distances,
-                                                 data.doses,
-                                                 flipped_doses,
-                                                 adjacency)
-                matches.append(match)
-            n_matches = self.get_num_matches(p1, matches, data.classes)
-            similarities = np.array([-m[0] for m in matches])#this is inverse because argsort is ascending
-            match_args = (np.argsort(similarities))[:n_matches]
-            all_matches.append(match_args)
-        return all_matches
+        scores, is_flipped = self.get_patient_similarities(data)
+        scores[np.arange(scores.shape[0]), np.arange(scores.shape[0])] = -np.inf
+        num_matches = self.get_all_num_matches(scores, data.classes)
+        match_args = self.get_top_args(scores, num_matches.max())
+        return [match_args[p, :num_matches[p]] for p in range(scores.shape[0])]
 
     def get_patient_similarity(self, p1, p2,
                             normal_distances, flipped_distances,
@@ -186,17 +299,12 @@ class KnnEstimator(Estimator):
             dose_matrix = Metrics.augment_mirrored(dose_matrix)
             outliers = outliers | set([o + n_patients for o in outliers])
         similarity = np.copy(similarity_matrix[:n_patients, :])
-        clusters = data.classes
-        predicted_doses = np.zeros((n_patients, dose_matrix.shape[1]))
-        for p in range( n_patients ):
-            scores = similarity[p, :]
-            if p not in outliers:
-                scores[list(outliers)] = 0
-            num_matches = self.get_num_matches(p, scores, clusters)
-            args = np.argsort(-scores)
-            args = args[0 : num_matches]
-
-            predicted_doses[p, :] = self.get_prediction(dose_matrix, scores, args, p)
+        #outliers aren't used as matches, except for other outliers
+        outlier_args = np.array(sorted(outliers)).astype('int64')
+        not_outlier = np.setdiff1d(np.arange(n_patients), outlier_args)
+        similarity[np.ix_(not_outlier, outlier_args)] = 0
+        num_matches = self.get_all_num_matches(similarity, data.classes)
+        predicted_doses = self.get_batch_predictions(dose_matrix, similarity, num_matches)
         return(predicted_doses)
 
     def get_prediction(self, dose_matrix, scores, args, patient):
@@ -234,7 +342,76 @@ class KnnEstimator(Estimator):
         return np.mean(weights*matched_doses, axis = 0)/weights.mean()
 
 
+    def fit(self, data, augmented = True, similarity_index = None):
+        #saves the dose matrix and outliers for the patientset so predict_one/predict_batch
+        #can give predictions for new patients without going through the whole cohort again.
+        #similarity_index (fitted on the same patients) is used by default when predicting from tumor distances
+        n_patients = data.get_num_patients()
+        dose_matrix = data.doses
+        outliers = ErrorChecker().get_data_outliers(data.doses)
+        if similarity_index is not None:
+            self.check_similarity_index(similarity_index, n_patients, augmented)
+        if augmented:
+            dose_matrix = Metrics.augment_mirrored(dose_matrix)
+            outliers = outliers | set([o + n_patients for o in outliers])
+        self.fit_doses = dose_matrix
+        self.fit_outliers = np.array(sorted(outliers)).astype('int64')
+        self.similarity_index = similarity_index
+        return self
+
+    def check_similarity_index(self, similarity_index, n_patients, augmented):
+        #the similarity index always gives scores against the normal and mirrored patients
+        if not augmented:
+            raise ValueError('a similarity index gives augmented scores, so fit needs augmented = True')
+        if similarity_index.get_num_patients() != n_patients:
+            raise ValueError('similarity index has ' + str(similarity_index.get_num_patients())
+                             + ' patients but the patientset has ' + str(n_patients))
+
+    def check_fitted(self):
+        if getattr(self, 'fit_doses', None) is None:
+            raise ValueError('fit() must be called before predict_one or predict_batch')
+
+    def predict_one(self, query, similarity_index = None, cluster_size = None):
+        #predicted doses for one new patient, see predict_batch
+        self.check_fitted()
+        query = np.asarray(query).reshape(1,-1)
+        clusters = None if cluster_size is None else [cluster_size]
+        return self.predict_batch(query, similarity_index, clusters)[0]
+
+    def predict_batch(self, queries, similarity_index = None, clusters = None):
+        #predicted doses for new patients (not in the patientset passed to fit)
+        #queries are rows of similarity scores against the fitted patients (including mirrored ones if augmented)
+        #or, if a similarity_index fitted on the same patients is given (here or in fit), the raw tumor distances of the new patients
+        #clusters is only used if match_type is 'clusters' and gives the cluster sizes for each query
+        self.check_fitted()
+        if similarity_index is None:
+            similarity_index = getattr(self, 'similarity_index', None)
+        if similarity_index is not None:
+            scores = similarity_index.query(queries)
+        else:
+            scores = np.array(queries, dtype = 'float64', ndmin = 2)
+        if scores.shape[1] != self.fit_doses.shape[0]:
+            raise ValueError('similarity scores have ' + str(scores.shape[1]) + ' columns but '
+                             + str(self.fit_doses.shape[0]) + ' patients were fitted')
+        #new patients are never outliers, so the outlier scores are always ignored
+        scores[:, self.fit_outliers] = 0
+        if self.match_type == 'threshold':
+            good_matches = np.sum(scores > self.match_threshold, axis = 1)
+            num_matches = np.maximum(self.min_matches, good_matches)
+        elif self.match_type == 'clusters':
+            if clusters is None:
+                raise ValueError('match_type clusters needs the cluster size of each query')
+            num_matches = np.maximum((np.sqrt(np.asarray(clusters)) + 1).astype('int64'), self.min_matches)
+        else:
+            num_matches = np.full((scores.shape[0],), self.min_matches)
+        return self.get_batch_predictions(self.fit_doses, scores, num_matches)
+
     def get_matches(self, similarity_matrix, data):
+        #similarity_matrix can also be a NeighborGraph or the file one was saved to
+        if isinstance(similarity_matrix, str):
+            similarity_matrix = NeighborGraph.load(similarity_matrix)
+        if isinstance(similarity_matrix, NeighborGraph):
+            return self.get_graph_matches(similarity_matrix, data)
         dose_matrix = data.doses
         clusters = data.classes
         #should return a list of matched patients
@@ -246,6 +423,33 @@ class KnnEstimator(Estimator):
             matches.append(patient_matches)
         return(matches)
 
+    def get_graph_matches(self, graph, data):
+        #get_matches using only the neighbors stored in the graph, which are already sorted.
+        #unless the whole row is stored, outliers are dropped from it instead of being set to 0, so each row
+        #needs at least num_matches other neighbors, or the matches wouldn't be the same as the full matrix (ValueError)
+        outliers = ErrorChecker().get_data_outliers(data.doses)
+        outlier_list = list(outliers)
+        n_patients = data.get_num_patients()
+        matches = []
+        for p in range(graph.get_num_patients()):
+            neighbors, scores, flipped = graph.get_row(p)
+            num_matches = self.get_num_matches(p, scores, data.classes)
+            if (self.match_type == 'threshold' and len(neighbors) < n_patients
+                and len(scores) > 0 and scores[-1] > self.match_threshold):
+                raise ValueError('every neighbor of patient ' + str(p) + ' in the graph is over the match threshold, '
+                                 + 'so the number of matches is unknown. Save the graph with a bigger k')
+            is_outlier = np.isin(neighbors, outlier_list)
+            if p not in outliers and len(neighbors) >= n_patients:
+                #the whole row is stored, so the outliers can be set to 0 like the full matrix
+                neighbors = neighbors[np.argsort(-np.where(is_outlier, 0, scores), kind = 'stable')]
+            elif p not in outliers:
+                neighbors = neighbors[~is_outlier]
+            if num_matches > len(neighbors):
+                raise ValueError('patient ' + str(p) + ' needs ' + str(num_matches) + ' matches but the graph only has '
+                                 + str(len(neighbors)) + ' usable neighbors. Save the graph with a bigger k')
+            matches.append(neighbors[:num_matches].astype('int64') + 1)
+        return matches
+
     def get_patient_matches(self, p, scores, data, outliers, clusters):
         num_matches = self.get_num_matches(p, scores, clusters)
         if p not in outliers:
@@ -266,6 +470,67 @@ class KnnEstimator(Estimator):
             matches = self.min_matches
         return matches
 
+class ThresholdTuner():
+    #finds the match_threshold and min_matches that give the lowest error for a threshold KnnEstimator.
+    #each row of the similarity matrix is sorted once, and the predictions for every (threshold, min_matches) pair
+    #come from cumulative sums of the weighted doses along that order instead of calling evaluate each time
+    def __init__(self, thresholds = None, min_matches = None):
+        if thresholds is None:
+            thresholds = np.linspace(.4, 1, 20)
+        if min_matches is None:
+            min_matches = np.arange(1, 20)
+        self.thresholds = np.asarray(thresholds)
+        self.min_matches = np.asarray(min_matches).astype('int64')
+
+    def get_errors(self, similarity_matrix, data):
+        #(n_thresholds x n_min_matches) matrix of the mean percent error from KnnEstimator.evaluate
+        n_patients = data.get_num_patients()
+        dose_matrix = data.doses
+        outliers = ErrorChecker().get_data_outliers(data.doses)
+        is_augmented = similarity_matrix.shape[0] > n_patients
+        if is_augmented: #if matrix is agumented
+            dose_matrix = Metrics.augment_mirrored(dose_matrix)
+            outliers = outliers | set([o + n_patients for o in outliers])
+        similarity = np.copy(similarity_matrix[:n_patients, :])
+        mean_dose = dose_matrix.mean(axis = 0)
+        errors = np.zeros((len(self.thresholds), len(self.min_matches)))
+        for p in range(n_patients):
+            scores = similarity[p, :]
+            if p not in outliers:
+                scores[list(outliers)] = 0
+            args = np.argsort(-scores)
+            sorted_scores = scores[args]
+            #number of scores > each threshold, the scores are in decending order
+            good_matches = np.searchsorted(-sorted_scores, -self.thresholds, side = 'left')
+            num_matches = np.maximum(good_matches.reshape(-1,1), self.min_matches.reshape(1,-1))
+            num_matches = np.minimum(num_matches, len(args))
+            max_matches = num_matches.max()
+            #sums of the first n weights and weighted doses, starting with n = 0
+            top_scores = sorted_scores[:max_matches]
+            weight_sums = np.append(0, np.cumsum(top_scores))[num_matches]
+            dose_sums = np.vstack([np.zeros((1, dose_matrix.shape[1])),
+                                   np.cumsum(top_scores.reshape(-1,1)*dose_matrix[args[:max_matches]], axis = 0)])
+            dose_sums = dose_sums[num_matches]
+            has_matches = (weight_sums > 0)[:,:,np.newaxis]
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                predictions = np.where(has_matches, dose_sums/weight_sums[:,:,np.newaxis], mean_dose)
+            errors += np.sum(np.abs(predictions - data.doses[p]), axis = 2)/np.sum(data.doses[p])
+        return errors/n_patients
+
+    def fit(self, similarity_matrix, data):
+        #saves the grid of errors and the best parameters, ties go to the first threshold then min_matches
+        self.errors = self.get_errors(similarity_matrix, data)
+        best = np.unravel_index(np.argmin(self.errors), self.errors.shape)
+        self.best_score = self.errors[best]
+        self.best_threshold = self.thresholds[best[0]]
+        self.best_min_matches = int(self.min_matches[best[1]])
+        return self
+
+    def get_estimator(self):
+        return KnnEstimator(match_type = 'threshold',
+                            match_threshold = self.best_threshold,
+                            min_matches = self.best_min_matches)
+
 class PSUpsampler():
 
     def __init__(self, clusterer = None):
@@ -322,7 +587,10 @@ class TreeKnnEstimator(KnnEstimator, SupervisedModel):
                                                       class_weight = 'balanced',
                                                       random_state=1)
 
-    def predict_doses(self, similarity_list, data, weight_matrix_loc = None):
+    def predict_doses(self, similarity_list, data, weight_matrix_loc = None, n_jobs = 1):
+        #n_jobs > 1 runs the leave-one-out fits in a process pool.  The feature matrix is shared with the
+        #workers as a memmap instead of being copied, and the upsampling is still drawn here in patient order,
+        #so the predictions are the same as the serial version
         qunatile = lambda x: quantile_transform(x, axis = 1, copy = True, n_quantiles = 20)
         similarity_list = [qunatile(s) for s in similarity_list]
         n_patients = data.get_num_patients()
@@ -332,43 +600,49 @@ class TreeKnnEstimator(KnnEstimator, SupervisedModel):
         if is_augmented: #if matrix is agumented
             dose_matrix = Metrics.augment_mirrored(dose_matrix)
             outliers = outliers | set([o + n_patients for o in outliers])
-        predicted_doses = np.zeros((n_patients, dose_matrix.shape[1]))
         clusters = self.get_feature_clusters(data)
         features, labels, positions = self.extract_features(similarity_list, dose_matrix,
                                          clusters, is_augmented)
-        for p in range(n_patients):
-
-            patient_positions = np.argwhere( np.any([p == positions, p + n_patients == positions], axis = 0) )[:,0]
-            train_x = np.delete(features, patient_positions, axis = 0)
-            train_labels = np.delete(labels, patient_positions, axis = 0)
-            upsampled_x, upsampled_y = self.upsample_clusters(train_x, train_labels, clusters[p])
-            self.match_model.fit(upsampled_x, upsampled_y)
-            patient_args = np.argwhere( p == positions[:,0] ).ravel()
-
-            match_probs = self.match_model.predict_proba(features[patient_args])[:,1]
-            match_probs = np.insert(match_probs, p, 0)
+        #generator so the training rows are only made when a fit is about to run
+        loo_tasks = ((self.get_loo_rows(p, positions, features, clusters[p], n_patients),
+                      np.argwhere( p == positions[:,0] ).ravel()) for p in range(n_patients))
+        if n_jobs == 1:
+            all_match_probs = (self.fit_loo_model(self.match_model, features, labels, train_rows, patient_args)
+                               for train_rows, patient_args in loo_tasks)
+        else:
+            all_match_probs = Parallel(n_jobs = n_jobs)(
+                    delayed(self.fit_loo_model)(clone(self.match_model), features, labels, train_rows, patient_args)
+                    for train_rows, patient_args in loo_tasks)
+        match_probs = np.zeros((n_patients, dose_matrix.shape[0]))
+        for p, patient_probs in enumerate(all_match_probs):
+            patient_probs = np.insert(patient_probs, p, 0)
             if is_augmented:
-                match_probs = np.insert(match_probs, p + n_patients, 0)
-            match_args = self.get_match_args(match_probs)
-            if weight_matrix_loc is None:
-                match_weights = match_probs
-            else:
-                match_weights = similarity_list[weight_matrix_loc][p, :]
-            dose_prediction = self.get_individual_dose_prediction(dose_matrix, match_weights, match_args)
-            predicted_doses[p,:] = dose_prediction
+                patient_probs = np.insert(patient_probs, p + n_patients, 0)
+            match_probs[p] = patient_probs
+        if weight_matrix_loc is None:
+            match_weights = match_probs
+        else:
+            match_weights = similarity_list[weight_matrix_loc][:n_patients, :]
+        predicted_doses = self.get_batch_predictions(dose_matrix, match_probs,
+                                                     self.get_match_counts(match_probs),
+                                                     weights = match_weights)
         return predicted_doses
 
+    def get_loo_rows(self, p, positions, features, cluster, n_patients, ratio = 2):
+        #rows of the feature matrix to train on when predicting patient p: every pair without p (or its mirror),
+        #followed by the rows upsampled from p's spatial cluster, drawn the same way as upsample_clusters
+        train_rows = np.argwhere( (positions[:,0] != p) & (positions[:,1] != p)
+                                 & (positions[:,1] != p + n_patients) ).ravel()
+        canidates = train_rows[features[train_rows, 0] == cluster]
+        count = ratio*(len(train_rows) - len(canidates) + 1)
+        return np.concatenate([train_rows, np.random.choice(canidates, count)])
+
     def upsample_clusters(self, x, y, cluster, ratio = 2):
         #specifically upsample the features in the same spaial group from the training class
         canidates = np.argwhere(x[:, 0] == cluster).ravel()
         count = ratio*(x.shape[0] - len(canidates) + 1)
-        upsampled_x = np.zeros((count, x.shape[1]))
-        upsampled_y = np.zeros((count,))
-        for s in range(count):
-            sample_arg = np.random.choice(canidates)
-            upsampled_x[s] = x[sample_arg]
-            upsampled_y[s] = y[sample_arg]
-        return np.vstack([x, upsampled_x]), np.hstack([y, upsampled_y])
+        sample_args = np.random.choice(canidates, count)
+        return np.vstack([x, x[sample_args]]), np.hstack([y, y[sample_args]])
 
     def get_individual_dose_prediction(self, doses, weights, args):
         match_doses = doses[args]
@@ -380,14 +654,25 @@ class TreeKnnEstimator(KnnEstimator, SupervisedModel):
         return weighted_doses
 
     def get_match_args(self, scores):
-        threshold = copy(self.match_threshold)
-        num_matches = 0
-        while num_matches < self.min_matches:
-            num_matches = len(np.argwhere(scores > threshold))
-            threshold = threshold - .01
+        num_matches = self.get_match_counts(scores.reshape(1,-1))[0]
         match_args = np.argsort(-scores)[:num_matches]
         return match_args
 
+    def get_match_counts(self, scores):
+        #number of matches for each row of scores.  The threshold starts at match_threshold
+        #and is lowered by .01 until at least min_matches scores are above it
+        if self.min_matches <= 0:
+            return np.zeros((scores.shape[0],)).astype('int64')
+        kth = min([self.min_matches, scores.shape[1]]) - 1
+        kth_scores = -np.partition(-scores, kth, axis = 1)[:, kth]
+        thresholds = [copy(self.match_threshold)]
+        while thresholds[-1] >= kth_scores.min():
+            thresholds.append(thresholds[-1] - .01)
+        thresholds = np.array(thresholds)
+        #first threshold below the kth best score of each row
+        row_thresholds = thresholds[np.searchsorted(-thresholds, -kth_scores, side = 'right')]
+        return np.sum(scores > row_thresholds.reshape(-1,1), axis = 1)
+
     def get_feature_clusters(self, data):
         dose_pca = Metrics.pca(data.doses, n_components = 3)
         clusters = KMeans(n_clusters = 5, random_state = 1).fit_predict(data.tumor_distances)
@@ -420,23 +705,10 @@ class TreeKnnEstimator(KnnEstimator, SupervisedModel):
     def extract_features(self, similarities, doses, clusters, is_augmented):
         true_similarity = self.get_true_matches(doses)
         num_patients = int(doses.shape[0]/(is_augmented + 1))
-        x = []
-        y = []
-        positions = []
-        for p1 in range(num_patients):
-            for p2 in range(num_patients*(1 + is_augmented)):
-                if p1 == p2%num_patients:
-                    continue
-                x_row = [clusters[p2%num_patients]]
-                for similarity in similarities:
-                    x_row.append(similarity[p1, p2])
-                x.append(x_row)
-                y.append(true_similarity[p1, p2])
-                positions.append([p1,p2])
-        x = np.array(x)
-        y = np.array(y)
-        positions = np.array(positions)
-        return [x, y, positions]
+        num_targets = num_patients*(1 + is_augmented)
+        target_clusters = clusters[np.arange(num_targets)%num_patients]
+        return self.get_pair_features(similarities, true_similarity, num_patients, num_targets,
+                                      leading = target_clusters)
 
 class TsimModel():
     #orginal-ish similarity model that gives a similarity matrix from get_simirity based on a spatial ssim
@@ -490,15 +762,18 @@ class TsimModel():
     def similarity(self, adjacency, distances, volumes, clusters, similarity_function = None):
         num_patients, num_organs = distances.shape
         num_original_patients = len(clusters)
-        score_matrix = np.zeros((num_patients, num_patients))
-        for patient1 in range(0, num_patients - 1):
-            for patient2 in range(patient1 + 1, num_patients):
-                if (patient1 % num_original_patients) == (patient2 % num_original_patients):
-                    continue
-                scores = self.pairwise_similarity(patient1, patient2,
-                                                     distances, volumes,
-                                                     clusters, adjacency)
-                score_matrix[patient1, patient2] = scores
+        if self.get_batch_metric() is not None:
+            score_matrix = self.batch_similarity(adjacency, distances, volumes, clusters)
+        else:
+            score_matrix = np.zeros((num_patients, num_patients))
+            for patient1 in range(0, num_patients - 1):
+                for patient2 in range(patient1 + 1, num_patients):
+                    if (patient1 % num_original_patients) == (patient2 % num_original_patients):
+                        continue
+                    scores = self.pairwise_similarity(patient1, patient2,
+                                                         distances, volumes,
+                                                         clusters, adjacency)
+                    score_matrix[patient1, patient2] = scores
         score_matrix += np.transpose(score_matrix)
 #        scale to between 0 and .99
         score_matrix = (score_matrix - score_matrix.min())
@@ -512,6 +787,42 @@ class TsimModel():
                 score_matrix[mirror_pos, mirror_pos] = 0
         return score_matrix
 
+    def get_batch_metric(self):
+        #gives which vectorized version of the similarity function to use, or None if there isn't one
+        if self.similarity_function in [self.local_ssim, Metrics.local_ssim]:
+            return 'ssim'
+        return Metrics.get_batch_metric(self.similarity_function)
+
+    def batch_similarity(self, adjacency, distances, volumes, clusters):
+        #gives the same upper triangle of scores as the pairwise_similarity loop in similarity,
+        #but each organ neighborhood is done for all pairs of patients at once
+        num_patients = distances.shape[0]
+        num_original_patients = len(clusters)
+        metric = self.get_batch_metric()
+        score_sum = np.zeros((num_patients, num_patients))
+        num_scores = 0
+        for organ in range(distances.shape[1]):
+            adjacent_args = adjacency[organ]
+            if len(adjacent_args) < 1:
+                continue
+            d = distances[:, adjacent_args]
+            v = volumes[:, adjacent_args]
+            if metric == 'ssim':
+                score_sum += Metrics.batch_local_ssim(d, v)
+            else:
+                score_sum += Metrics.pairwise_sim(d, metric = metric)
+            num_scores += 1
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            score_matrix = score_sum/num_scores
+        original_args = np.arange(num_patients) % num_original_patients
+        #zero out comparisons between a patient and its mirror, and between classes if use_classes is set
+        same_patient = original_args.reshape(-1,1) == original_args.reshape(1,-1)
+        score_matrix[same_patient] = 0
+        if self.use_classes:
+            patient_clusters = np.asarray(clusters)[original_args]
+            score_matrix[patient_clusters.reshape(-1,1) != patient_clusters.reshape(1,-1)] = 0
+        return np.triu(score_matrix, 1)
+
     def pairwise_similarity(self, patient1, patient2, distances, volumes, clusters, adjacency = None):
         if self.use_classes:
             p1 = patient1 % len(clusters)
@@ -561,6 +872,13 @@ class TJaccardModel(TsimModel):
 
 class OsimModel(TsimModel):
     #variant that calculates the tsim similarity using organ-organ distances, rather than tumor-organ distances
+    def __init__(self, max_distance = 50, patients = None, organs = None,
+                 similarity_function = None, use_classes = False, batched = True):
+        #batched compares the organ-organ blocks of all patients at once with batch_similarity.
+        #both modes treat each block as one flattened vector, so they give the same scores (see check_batched)
+        super(OsimModel, self).__init__(max_distance, patients, organs, similarity_function, use_classes)
+        self.batched = batched
+
     def get_similarity(self, data):
         #data is assumed to be a patientset object for now
         if self.patients is None:
@@ -579,6 +897,11 @@ class OsimModel(TsimModel):
         return scores
 
     def similarity(self, adjacency, distances, volumes, clusters, similarity_function = None):
+        if self.batched and similarity_function is None:
+            score_matrix = self.batch_similarity(adjacency, distances, volumes, clusters)
+            score_matrix += np.transpose(score_matrix)
+            score_matrix = .99*(score_matrix - score_matrix.min())/(score_matrix.max() - score_matrix.min())
+            return score_matrix
         if similarity_function is None:
             similarity_function = self.local_ssim
         num_patients, num_organs = (distances.shape[2], distances.shape[0])
@@ -592,8 +915,8 @@ class OsimModel(TsimModel):
                     adjacent_args = adjacency[organ]
                     if len(adjacent_args) < 1:
                         continue
-                    d1 = distances[adjacent_args, :, patient1][:, adjacent_args]
-                    d2 = distances[adjacent_args, :, patient2][:, adjacent_args]
+                    d1 = distances[adjacent_args, :, patient1][:, adjacent_args].ravel()
+                    d2 = distances[adjacent_args, :, patient2][:, adjacent_args].ravel()
                     similarity_score = similarity_function(d1,d2)
                     scores.append( similarity_score )
                 score_matrix[patient1, patient2] = np.mean(scores)
@@ -602,6 +925,50 @@ class OsimModel(TsimModel):
         score_matrix = .99*(score_matrix - score_matrix.min())/(score_matrix.max() - score_matrix.min())
         return score_matrix
 
+    def batch_similarity(self, adjacency, distances, volumes, clusters, max_chunk_size = 2**24):
+        #gathers the (adjacent organs x adjacent organs) block of every patient for a group of organs
+        #into one zero-padded (n_organs x n_patients x max_block_size) array and gets the ssim for all pairs
+        #from batched reductions.  organs are sorted by neighborhood size so groups need less padding,
+        #and groups are limited to ~max_chunk_size values. returns the upper triangle of mean scores
+        num_patients, num_organs = (distances.shape[2], distances.shape[0])
+        organs = [organ for organ in range(num_organs) if len(adjacency[organ]) > 0]
+        organs = sorted(organs, key = lambda organ: len(adjacency[organ]))
+        score_sum = np.zeros((num_patients, num_patients))
+        start = 0
+        while start < len(organs):
+            end = start + 1
+            while end < len(organs):
+                largest_block = len(adjacency[organs[end]])**2
+                if (end - start + 1)*num_patients*max([largest_block, num_patients]) > max_chunk_size:
+                    break
+                end += 1
+            chunk = organs[start:end]
+            counts = np.array([len(adjacency[organ])**2 for organ in chunk])
+            blocks = np.zeros((len(chunk), num_patients, counts.max()))
+            for i in range(len(chunk)):
+                adjacent_args = adjacency[chunk[i]]
+                block = distances[np.ix_(adjacent_args, adjacent_args)]
+                blocks[i, :, :counts[i]] = block.reshape(-1, num_patients).T
+            score_sum += Metrics.batch_local_ssim(blocks, counts = counts).sum(axis = 0)
+            start = end
+        score_matrix = score_sum/len(organs)
+        return np.triu(score_matrix, 1)
+
+    def check_batched(self, data, n_patients = 10, tol = 1e-8):
+        #compares the batched and looped scores on the first n_patients, returns True if they agree
+        adjacency = self.get_adjacency_lists(data.organ_distances)
+        distances = data.all_organ_distances[:, :, :n_patients]
+        batched = self.batched
+        scores = []
+        for mode in [True, False]:
+            self.batched = mode
+            scores.append(self.similarity(adjacency, distances, data.volumes, data.classes))
+        self.batched = batched
+        if not np.allclose(scores[0], scores[1], rtol = 0, atol = tol, equal_nan = True):
+            print('error, batched and looped osim scores differ by ', np.nanmax(np.abs(scores[0] - scores[1])))
+            return False
+        return True
+
 class SimilarityFuser(SupervisedModel):
     #class that uses (logistic regression) to map a list of similarity scores to a single score
     #attempts to classify each vector as a neighbor (dose error < some number)
@@ -617,47 +984,48 @@ class SimilarityFuser(SupervisedModel):
                                        random_state = 0)
         self.model = model
 
-    def get_similarity(self, db, similarity_matrices, classes = None):
+    def get_similarity(self, db, similarity_matrices, classes = None, n_jobs = 1, warm_start = False):
+        #n_jobs > 1 runs the leave-one-out fits in a process pool sharing the (memmapped) feature matrix.
+        #warm_start fits the model on all the pairs once and starts each leave-one-out fit from those coefficients,
+        #only for models with a warm_start option like the default logistic regression
         [x,y, positions] = self.extract_features(similarity_matrices, db.get_num_patients(), db, classes)
         final_similarity = np.zeros(similarity_matrices[0].shape)
-        x = (x-x.min(axis=0))/(x.max(axis=0) - x.min(axis=0))
-        for p in range(db.get_num_patients() - 1):
-            test_pairs = np.where(positions == p)[0]
-            x_train = np.delete(x, test_pairs, axis = 0)
-            y_train = np.delete(y, test_pairs, axis = 0)
-            predict_pairs  = np.where(positions[:,0] == p)[0]
-            x_test = x[predict_pairs,:]
-            self.model.fit(x_train, y_train)
-            y_pred = self.model.predict_proba(x_test)[:, 1]
+        x = self.normalize_features(x)
+        warm_model = None
+        if warm_start:
+            warm_model = clone(self.model).set_params(warm_start = True)
+            warm_model.fit(x, y)
+        all_predictions = self.get_loo_predictions(x, y, positions, db.get_num_patients() - 1,
+                                                   n_jobs = n_jobs, warm_model = warm_model)
+        for p, y_pred in enumerate(all_predictions):
             final_similarity[p, :] = np.insert(y_pred, p, 0)
 #        final_similarity += final_similarity.transpose()
         return(final_similarity)
 
+    def get_loo_predictions(self, x, y, positions, n_loo, n_jobs = 1, warm_model = None, probability = True):
+        #predictions for patients 0 to n_loo - 1, each from a model fit without any pair that includes the patient.
+        #with a warm_model each fit starts from a copy of it instead of refitting self.model
+        def get_model():
+            if warm_model is not None:
+                return deepcopy(warm_model)
+            if n_jobs == 1:
+                return self.model
+            return clone(self.model)
+        loo_tasks = ((get_model(),
+                      np.argwhere(~np.any(positions == p, axis = 1)).ravel(),
+                      np.argwhere(positions[:,0] == p).ravel()) for p in range(n_loo))
+        if n_jobs == 1:
+            return [self.fit_loo_model(model, x, y, train_rows, test_rows, probability)
+                    for model, train_rows, test_rows in loo_tasks]
+        return Parallel(n_jobs = n_jobs)(
+                delayed(self.fit_loo_model)(model, x, y, train_rows, test_rows, probability)
+                for model, train_rows, test_rows in loo_tasks)
 
     def extract_features(self, similarities, num_patients, data, classes):
         true_similarity = self.get_true_matches(data)
         if classes is not None:
             classes = (classes - np.min(classes))/(np.max(classes) - np.min(classes))
-        x = []
-        y = []
-        positions = []
-        for p1 in range(num_patients):
-            for p2 in range(num_patients):
-                if p1 == p2:
-                    continue
-                x_row = []
-                for similarity in similarities:
-                    x_row.append(similarity[p1, p2])
-                if classes is not None:
-                    target_class = classes[p2]
-                    x_row.append(target_class)
-                x.append(x_row)
-                y.append(true_similarity[p1, p2])
-                positions.append([p1,p2])
-        x = np.array(x)
-        y = np.array(y)
-        positions = np.array(positions)
-        return [x, y, positions]
+        return self.get_pair_features(similarities, true_similarity, num_patients, trailing = classes)
 
     def get_true_matches(self, data, negative_class = 0):
         min_matches = self.min_matches
@@ -685,18 +1053,13 @@ class SimilarityBooster(SimilarityFuser):
 #            from sklearn.ensemble import AdaBoostRegressor
 #            self.model = AdaBoostRegressor(learning_rate=.1, loss = 'square')
 
-    def get_similarity(self, db, similarity_matrices):
+    def get_similarity(self, db, similarity_matrices, n_jobs = 1):
         [x,y, positions] = self.extract_features(similarity_matrices, db.get_num_patients(), db)
         final_similarity = np.zeros(similarity_matrices[0].shape)
-        x = (x-x.min(axis=0))/(x.max(axis=0) - x.min(axis=0))
-        for p in range(db.get_num_patients()):
-            test_pairs = np.where(positions == p)[0]
-            x_train = np.delete(x, test_pairs, axis = 0)
-            y_train = np.delete(y, test_pairs, axis = 0)
-            predict_pairs  = np.where(positions[:,0] == p)[0]
-            x_test = x[predict_pairs,:]
-            self.model.fit(x_train, y_train)
-            y_pred = self.model.predict(x_test)
+        x = self.normalize_features(x)
+        all_predictions = self.get_loo_predictions(x, y, positions, db.get_num_patients(),
+                                                   n_jobs = n_jobs, probability = False)
+        for p, y_pred in enumerate(all_predictions):
             print(y_pred.shape)
             final_similarity[p, :] = np.insert(y_pred, p, 0)
 #        final_similarity += final_similarity.transpose()
@@ -705,23 +1068,7 @@ class SimilarityBooster(SimilarityFuser):
 
     def extract_features(self, similarities, num_patients, data):
         true_similarity = (self.get_true_matches(data))
-        x = []
-        y = []
-        positions = []
-        for p1 in range(num_patients):
-            for p2 in range(num_patients):
-                if p1 == p2:
-                    continue
-                x_row = []
-                for similarity in similarities:
-                    x_row.append(similarity[p1, p2])
-                x.append(x_row)
-                y.append(true_similarity[p1, p2])
-                positions.append([p1,p2])
-        x = np.array(x)
-        y = np.array(y)
-        positions = np.array(positions)
-        return [x, y, positions]
+        return self.get_pair_features(similarities, true_similarity, num_patients)
 
     def get_true_matches(self, data):
         error = self.get_match_error(data)
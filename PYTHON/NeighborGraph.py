@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Sparse top-k version of a similarity matrix.  Only the best k neighbors of each patient are kept
+(in CSR form), which is all the knn estimators and the front end use, so it's O(n*k) to save and load
+"""
+import numpy as np
+
+class NeighborGraph():
+    #row p has neighbors[indptr[p]:indptr[p+1]], sorted by score (highest first, then by index).
+    #flipped marks neighbors where the mirrored version of the patient was the better match
+
+    def __init__(self, indptr, neighbors, scores, flipped = None, ids = None):
+        self.indptr = np.asarray(indptr).astype('int64')
+        self.neighbors = np.asarray(neighbors).astype('int32')
+        self.scores = np.asarray(scores)
+        if flipped is None:
+            flipped = np.zeros(self.neighbors.shape)
+        self.flipped = np.asarray(flipped).astype('bool')
+        self.ids = None if ids is None else np.asarray(ids)
+
+    @staticmethod
+    def from_similarity(similarity, k = 50, flipped = None, ids = None, n_patients = None, dtype = 'float64'):
+        #similarity is (n x n), or augmented (n x 2n or 2n x 2n) with the mirrored patients in the second half
+        #when n_patients is given, in which case each pair uses the better of the normal and mirrored score like in export.
+        #flipped is an optional (n x n) boolean mask for when the scores have already been combined
+        similarity = np.asarray(similarity)
+        if n_patients is not None and n_patients < similarity.shape[1]:
+            normal = similarity[:n_patients, :n_patients]
+            mirrored = similarity[:n_patients, n_patients:2*n_patients]
+            flipped = mirrored > normal
+            similarity = np.maximum(normal, mirrored)
+        n_patients = similarity.shape[0]
+        if flipped is None:
+            flipped = np.zeros(similarity.shape).astype('bool')
+        k = min([k, similarity.shape[1]])
+        rows = np.arange(n_patients).reshape(-1,1)
+        top_args = np.argpartition(-similarity, k - 1, axis = 1)[:, :k]
+        top_scores = similarity[rows, top_args]
+        order = np.lexsort((top_args, -top_scores), axis = 1)
+        top_args = np.take_along_axis(top_args, order, axis = 1)
+        return NeighborGraph(np.arange(n_patients + 1)*k,
+                             top_args.ravel(),
+                             similarity[rows, top_args].ravel().astype(dtype),
+                             np.asarray(flipped)[rows, top_args].ravel(),
+                             ids)
+
+    def get_num_patients(self):
+        return len(self.indptr) - 1
+
+    def get_row(self, p):
+        #(neighbor positions, scores, flipped) for patient p
+        start, stop = self.indptr[p], self.indptr[p + 1]
+        return self.neighbors[start:stop], self.scores[start:stop], self.flipped[start:stop]
+
+    def save(self, file):
+        arrays = {'indptr': self.indptr, 'neighbors': self.neighbors,
+                  'scores': self.scores, 'flipped': self.flipped}
+        if self.ids is not None:
+            arrays['ids'] = self.ids
+        np.savez_compressed(file, **arrays)
+
+    @staticmethod
+    def load(file):
+        with np.load(file, allow_pickle = False) as graph:
+            ids = graph['ids'] if 'ids' in graph.files else None
+            return NeighborGraph(graph['indptr'], graph['neighbors'],
+                                 graph['scores'], graph['flipped'], ids)
@@ -5,6 +5,7 @@ Created on Mon Feb  4 15:18:10 2019
 @author: Andrew
 """
 import numpy as np
+import pandas as pd
 from Constants import Constants
 from collections import OrderedDict, namedtuple
 
@@ -98,7 +99,9 @@ class Patient():
         except:
             self.packs_per_year = 0
         self.smoking = Patient.smoking_map.get(info['Smoking status at Diagnosis (Never/Former/Current)'],0)
-        centroid_data = self.get_doses_file_info(doses, distances)
+        #dense version of the distance file, all the distance lookups use this
+        self.roi_distances, self.roi_index = self.get_distance_table(distances)
+        centroid_data = self.get_doses_file_info(doses)
         #I make a new matrix, so the order of centroid data isn't the same as the orginal csv
         self.doses = centroid_data[:, 4]
         self.min_doses = centroid_data[:, 5]
@@ -110,7 +113,7 @@ class Patient():
         self.get_lymph_node_data(info)
         #distances is a symetric matrix sorted by the Constants.organ_list
         if use_distances:
-            self.distances = self.gen_distance_matrix(distances)
+            self.distances = self.gen_distance_matrix()
         #store the entries without gtvp for future study
         (self.tumor_volume, self.tumor_distances, self.mean_tumor_distances, self.max_tumor_distances, self.tumor_position) = self.get_main_tumor()
         self.laterality = self.get_laterality(self.gtvs)
@@ -172,7 +175,7 @@ class Patient():
             Constants.missing_organs[self.id] = {'organs': diff}
         return
 
-    def get_doses_file_info(self, doses, dists):
+    def get_doses_file_info(self, doses):
         #rename the columns so they're consistent, now done in dataset so I can read which set it's from
 #        doses.columns = Constants.centroid_file_names
         #move centroids so the center of the cloud is at zero?
@@ -190,7 +193,7 @@ class Patient():
                 volume = gtv.volume
                 position = gtv[['x','y','z']].values
                 doses = gtv[['min_dose','mean_dose','max_dose']]
-                distances = self.get_tumor_distances(name, dists)
+                distances = self.get_tumor_distances(name)
                 min_dist = np.argmin(distances)
                 organ = Constants.organ_list[min_dist]
             except:
@@ -211,7 +214,7 @@ class Patient():
             else:
                 break
         #merge overlapping secondary tumors
-        self.merge_gtvns(self.gtvs, dists)
+        self.merge_gtvns(self.gtvs)
         #get the info the centers, volumes, nad doses for all the things
         centroid_matrix = np.zeros((Constants.num_organs,7)) #row = x,y,z,volume,dose
         for idx in range(0, Constants.num_organs):
@@ -228,19 +231,18 @@ class Patient():
                 #print('patient ', self.id, ' is missing organ ', organ, ' centroid data')
         return(centroid_matrix)
 
-    def merge_gtvns(self, gtvs, dists):
+    def merge_gtvns(self, gtvs):
         #merges gtvs where there is overlap between them into a single gtv
         #calculates which gtvs overlap, and uses combine gtvs to get a single gtv
         if len(gtvs) <= 2:
             return gtvs
-        dists = dists.set_index(['Reference ROI', 'Target ROI']).sort_index()
         new_gtvs = []
         for i in range(0,len(gtvs)):
             gtv1 = gtvs[i]
             new_gtvs.append(set([i,i]))
             for ii in range(i+1, len(gtvs)): # I think I need to include itself?
                 gtv2 = gtvs[ii]
-                if self.gtv_overlap(gtv1.name, gtv2.name, dists):
+                if self.gtv_overlap(gtv1.name, gtv2.name):
                     new_gtvs.append(set([i,ii]))
         if len(new_gtvs) > 1:
             for idx in np.arange(len(new_gtvs) - 1, 0, -1):
@@ -288,14 +290,10 @@ class Patient():
         combined_gtv = GTV(name, total_volume, position, doses, distances, organ)
         return combined_gtv
 
-    def gtv_overlap(self, name1, name2, dists):
-        try:
-            distance = (dists.loc[name1, name2])['Eucledian Distance (mm)']
-        except:
-            try:
-                distance = (dists.loc[name2, name1])['Eucledian Distance (mm)']
-            except:
-                return False
+    def gtv_overlap(self, name1, name2):
+        distance = self.lookup_distances([name1], [name2])[0]
+        if np.isnan(distance):
+            return False
         return (distance <= 0)
 
     def center_centroids(self, centroids):
@@ -306,41 +304,49 @@ class Patient():
         centroids.z -= centroids.z.mean()
         return(centroids)
 
-    def gen_distance_matrix(self, dists):
+    def get_distance_table(self, dists):
+        #pivots the long format distance file into a (n_rois + 1) x (n_rois + 1) array
+        #and a dict mapping roi names to rows. entries are stored as (reference, target) and missing pairs are nan.
+        #the last row/column is left as nan so names that aren't in the file can point there
+        names = np.concatenate([dists['Reference ROI'].values, dists['Target ROI'].values])
+        codes, unique_names = pd.factorize(names)
+        n_rois = len(unique_names)
+        roi_index = {name: i for i, name in enumerate(unique_names)}
+        rows = codes[:len(dists)]
+        cols = codes[len(dists):]
+        values = dists['Eucledian Distance (mm)'].values.astype('float64')
+        table = np.full((n_rois + 1, n_rois + 1), np.nan)
+        #assign in reverse so the first entry is kept if a pair is duplicated
+        table[rows[::-1], cols[::-1]] = values[::-1]
+        return table, roi_index
+
+    def lookup_distances(self, names1, names2):
+        #gets the distance between each pair of names, using either order of the pair. nan if missing
+        missing = len(self.roi_index)
+        args1 = np.array([self.roi_index.get(name, missing) for name in names1], dtype = 'int64')
+        args2 = np.array([self.roi_index.get(name, missing) for name in names2], dtype = 'int64')
+        distances = self.roi_distances[args1, args2]
+        reverse_distances = self.roi_distances[args2, args1]
+        return np.where(np.isnan(distances), reverse_distances, distances)
+
+    def gen_distance_matrix(self):
         #generates a symetric 45x45 matrix of organ-organ distances
-        dist_matrix = np.zeros(( Constants.num_organs, Constants.num_organs))
-        dists = dists.set_index(['Reference ROI', 'Target ROI']).sort_index()
         alphabetical_organ_list = sorted(Constants.organ_list)
-        for row in range(0, Constants.num_organs):
-            for col in range(row + 1, Constants.num_organs):
-                organ1 = alphabetical_organ_list[row]
-                organ2 = alphabetical_organ_list[col]
-                try:
-                    dist_matrix[row, col] = (dists.loc[organ1, organ2])['Eucledian Distance (mm)']
-                except:
-                    try:
-                        dist_matrix[row, col] = (dists.loc[organ2, organ1])['Eucledian Distance (mm)']
-                    except:
-                        dist_matrix[row, col] = 0
-                        print(self.id, ' ', organ1, ' ', organ2, ' missing')
+        missing = len(self.roi_index)
+        args = np.array([self.roi_index.get(organ, missing) for organ in alphabetical_organ_list])
+        dist_matrix = self.roi_distances[np.ix_(args, args)]
+        dist_matrix = np.where(np.isnan(dist_matrix), dist_matrix.T, dist_matrix)
+        dist_matrix = np.triu(dist_matrix, 1)
+        for (row, col) in np.argwhere(np.isnan(dist_matrix)):
+            print(self.id, ' ', alphabetical_organ_list[row], ' ', alphabetical_organ_list[col], ' missing')
+        dist_matrix = np.nan_to_num(dist_matrix)
         dist_matrix += np.transpose(dist_matrix)
         return(dist_matrix)
 
-    def get_tumor_distances(self, name, dists):
+    def get_tumor_distances(self, name):
         #gets the tumor-organ distances
-        gtv_dists = np.zeros((Constants.num_organs,))
-        dists = dists.set_index(['Reference ROI', 'Target ROI']).sort_index()
-        for idx in range(0, Constants.num_organs):
-            organ = Constants.organ_list[idx]
-            try:
-                tumor_row = dists.loc[name, organ]
-                gtv_dists[idx] = tumor_row['Eucledian Distance (mm)']
-            except:
-                try:
-                    tumor_row = dists.loc[organ, name]
-                    gtv_dists[idx] = tumor_row['Eucledian Distance (mm)']
-                except:
-                    gtv_dists[idx] = float(0)
+        gtv_dists = self.lookup_distances([name]*Constants.num_organs, Constants.organ_list)
+        gtv_dists[np.isnan(gtv_dists)] = float(0)
         return(gtv_dists)
 
     def get_main_tumor(self):
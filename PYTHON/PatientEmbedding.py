@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Saves the tsne and mds views from analysis.export so they don't have to be refit every time.
+New patients are placed into the existing views instead (O(n) each): the tsne coordinates are
+interpolated from the nearest patients by tumor distance, and the mds coordinates are found
+by only moving the new point with guttman (smacof) updates
+"""
+import numpy as np
+
+class PatientEmbedding():
+
+    def __init__(self, ids, tumor_distances, distance_tsne, similarity_embedding,
+                 n_neighbors = 5, n_iter = 300, tol = 1e-6):
+        #n_neighbors is used for the tsne interpolation and the starting point of the mds updates
+        self.ids = list(ids)
+        self.tumor_distances = np.asarray(tumor_distances, dtype = 'float64')
+        self.distance_tsne = np.asarray(distance_tsne, dtype = 'float64')
+        self.similarity_embedding = np.asarray(similarity_embedding, dtype = 'float64')
+        self.n_neighbors = n_neighbors
+        self.n_iter = n_iter
+        self.tol = tol
+        self.slots = {patient_id: p for p, patient_id in enumerate(self.ids)}
+
+    def get_num_patients(self):
+        return len(self.ids)
+
+    def get_positions(self, ids):
+        #position of each id in the embedding, -1 for patients that haven't been added
+        return np.array([self.slots.get(patient_id, -1) for patient_id in ids]).astype('int64')
+
+    def get_tsne(self, ids):
+        return self.distance_tsne[self.get_positions(ids)]
+
+    def get_mds(self, ids):
+        return self.similarity_embedding[self.get_positions(ids)]
+
+    def interpolate(self, distances, coordinates):
+        #inverse distance weighted average of the coordinates of the closest n_neighbors points
+        k = min([self.n_neighbors, len(distances)])
+        args = np.argpartition(distances, k - 1)[:k]
+        if distances[args].min() <= 0:
+            return coordinates[args[distances[args] <= 0]].mean(axis = 0)
+        weights = 1/distances[args]
+        return np.dot(weights, coordinates[args])/weights.sum()
+
+    def place_tsne(self, tumor_distances):
+        distances = np.linalg.norm(self.tumor_distances - tumor_distances, axis = 1)
+        return self.interpolate(distances, self.distance_tsne)
+
+    def place_mds(self, dissimilarity, anchors):
+        #minimizes the mds stress for just the new point, with the anchor points fixed.
+        #dissimilarity[j] is the dissimilarity between the new patient and the patient in position anchors[j]
+        points = self.similarity_embedding[anchors]
+        x = self.interpolate(dissimilarity, points)
+        for i in range(self.n_iter):
+            diff = x - points
+            norms = np.linalg.norm(diff, axis = 1)
+            ratio = np.divide(dissimilarity, norms, out = np.zeros(norms.shape), where = norms > 0)
+            new_x = (points + ratio.reshape(-1,1)*diff).mean(axis = 0)
+            if np.linalg.norm(new_x - x) < self.tol:
+                return new_x
+            x = new_x
+        return x
+
+    def add_patients(self, ids, tumor_distances, dissimilarity, anchors = None):
+        #dissimilarity is (new patients x anchors), where anchors are the positions of the patients
+        #the columns refer to (defaults to everything already in the embedding).
+        #new patients are placed with respect to the current patients, not each other
+        tumor_distances = np.asarray(tumor_distances, dtype = 'float64').reshape(len(ids), -1)
+        dissimilarity = np.asarray(dissimilarity, dtype = 'float64').reshape(len(ids), -1)
+        anchors = np.arange(self.get_num_patients()) if anchors is None else np.asarray(anchors)
+        new = []
+        for p in range(len(ids)):
+            if ids[p] in self.slots:
+                print('patient ', ids[p], ' is already in the embedding')
+            else:
+                new.append(p)
+        if len(new) == 0:
+            return
+        new_tsne = np.array([self.place_tsne(tumor_distances[p]) for p in new])
+        new_mds = np.array([self.place_mds(dissimilarity[p], anchors) for p in new])
+        for p in new:
+            self.slots[ids[p]] = len(self.ids)
+            self.ids.append(ids[p])
+        self.tumor_distances = np.vstack([self.tumor_distances, tumor_distances[new]])
+        self.distance_tsne = np.vstack([self.distance_tsne, new_tsne])
+        self.similarity_embedding = np.vstack([self.similarity_embedding, new_mds])
+
+    def add_patient(self, patient_id, tumor_distances, dissimilarity, anchors = None):
+        self.add_patients([patient_id], tumor_distances, dissimilarity, anchors)
+
+    def save(self, file):
+        np.savez_compressed(file, ids = np.array(self.ids),
+                            tumor_distances = self.tumor_distances,
+                            distance_tsne = self.distance_tsne,
+                            similarity_embedding = self.similarity_embedding,
+                            settings = np.array([self.n_neighbors, self.n_iter, self.tol]))
+
+    @staticmethod
+    def load(file):
+        with np.load(file, allow_pickle = False) as embedding:
+            n_neighbors, n_iter, tol = embedding['settings']
+            return PatientEmbedding(embedding['ids'].tolist(), embedding['tumor_distances'],
+                                    embedding['distance_tsne'], embedding['similarity_embedding'],
+                                    n_neighbors = int(n_neighbors), n_iter = int(n_iter), tol = tol)
@@ -5,37 +5,69 @@ Created on Mon Jan 21 17:22:31 2019
 """
 from numpy.random import seed
 seed(1)
-from tensorflow import set_random_seed
-set_random_seed(2)
 
 from glob import glob
 from re import findall, match, sub
 import json
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 from collections import OrderedDict
+from copy import copy
 from Constants import Constants
 from Patient import Patient
 from ErrorChecker import ErrorChecker
 from preprocessing import Denoiser
 from cv2 import estimateAffine3D
 from Metrics import lcr_args, get_flip_args
+from Patient import GTV
 
 class PatientSet():
+    #per-patient arrays that are stored in the binary cache, everything that read_patient_data
+    #computes except for the gtv lists, which are flattened seperately
+    cache_attributes = ['doses', 'max_doses', 'min_doses', 'tumor_distances', 'volumes',
+                        'lymph_nodes', 'classes', 'pathological_grades', 'therapy_type',
+                        'n_categories', 't_categories', 'genders', 'ages', 'dose_fractions',
+                        'prescribed_doses', 'centroids', 'lateralities', 'subsites', 'ids',
+                        'ajcc8', 'hpv', 'has_gtvp', 'aspiration', 'aspiration_change',
+                        'smoking', 'packs_per_year', 'feeding_tubes',
+                        'mean_tumor_distances', 'max_tumor_distances']
+    #bump this if the parsing changes so old cache files are ignored
+    cache_version = 2
+    #every attribute with one entry per patient, and the axis the patients are on ('list' for python lists).
+    #these are kept in self.columns as [array, index] so subset only has to update the indices
+    patient_columns = OrderedDict([(attr, 0) for attr in cache_attributes]
+                                  + [('gtvs', 'list'), ('all_organ_distances', 2)])
 
     def __init__(self, outliers = [], root = 'data\\patients_v*\\',
-                 use_distances = False, use_clean_subset = True, denoise = True):
+                 use_distances = False, use_clean_subset = True, denoise = True,
+                 cache_dir = None, n_jobs = 1, lazy = False):
+        #cache_dir is a folder for a binary copy of the parsed data, so later runs on the same
+        #files can skip reading the csvs.  None means the csvs are always parsed
+        #n_jobs is the number of processes used to parse the csvs, -1 uses all cores
+        #denoise can be True, False, or 'cached' to save/reuse the denoiser results in cache_dir (or data/cache)
+        #lazy only loads each array from the cache file the first time it's used (needs cache_dir)
         self.classes = None
         self.num_classes = 0
+        self.cache_dir = cache_dir
+        self.lazy = lazy
+        self.lazy_file = None
+        self.columns = {}
+        if lazy and cache_dir is None:
+            print('lazy loading needs a cache_dir, loading all the data')
         self.left, center, self.right = lcr_args()
-        self.read_patient_data(root, outliers, use_distances)
+        self.read_patient_data(root, outliers, use_distances, n_jobs)
+        self.register_columns()
         if use_clean_subset:
             self.clean_values()
         if denoise:
-            self.denoise_tumor_distances()
+            #denoise = 'cached' reuses a saved denoiser for the same tumor distances and settings
+            self.denoise_tumor_distances(use_cache = (denoise == 'cached'))
         print('\npatient data loaded...\n')
 
-    def read_patient_data(self, root, outliers, use_distances):
+    def read_patient_data(self, root, outliers, use_distances, n_jobs = 1):
 
         #sorts by size of largest integer string, which is the id for our files
         file_sort = lambda x: sorted(x, key =
@@ -48,6 +80,11 @@ class PatientSet():
         ids = self.delete_outliers(outliers, distance_files, dose_files)
         metadata_file = 'data\\patient_info.csv'
         assert(len(distance_files) == len(dose_files))
+        if self.cache_dir is not None:
+            cache_file = self.get_cache_file(distance_files + dose_files + [metadata_file],
+                                             use_distances)
+            if os.path.exists(cache_file) and self.load_cache(cache_file, use_distances, lazy = self.lazy):
+                return
         #maps a position 0-len(files) to the dummy id for a patient
         num_patients = len(ids)
         metadata = pd.read_csv(metadata_file,
@@ -56,6 +93,8 @@ class PatientSet():
                                           13,14,15,16, 17,18,31,32,35,36,37,38]
                                ).loc[ids]
 #        print(metadata.columns)
+        parsed_patients = self.parse_patients(distance_files, dose_files, ids,
+                                              metadata, use_distances, n_jobs)
 
         #super inefficient way of reading in the data
         patients = OrderedDict()
@@ -97,29 +136,8 @@ class PatientSet():
         #putting all the data into a patient object for further objectification
 
         for patient_index in range(0, num_patients):
-            dataset_version = int(findall('patients_v([0-9])', distance_files[patient_index])[0])
-            assert(dataset_version in [2,3])
-            #these are indexed by name of organ
-            #we only use 3 rows but half of them have a comma missing in the header between the last two rows
-            distances = pd.read_csv(distance_files[patient_index],
-                                    usecols = [0,1,2]).dropna()
-            #renames anything that is equivalent to GTVp/GTVn to the correct format
-            distances = self.fix_tumor_names(distances)
-            doses = pd.read_csv(dose_files[patient_index],
-                                usecols = [0,1,2,3,4,5,6,7]).dropna()
-            #pateints_v3 dataset has a different way of ording the columns (and different spelling)
-            if dataset_version == 2:
-                doses.columns = Constants.centroid_file_names_v2
-            elif dataset_version == 3:
-                doses.columns = Constants.centroid_file_names_v3
-            doses = self.fix_tumor_names(doses)
-            #misc patient info - laterality, subsite, total dose, etc
-            info = metadata.loc[ids[patient_index]]
-            group = self.get_patient_class(ids[patient_index], doses.set_index('ROI').mean_dose)
-            #uses a new patient class to acually parse/process data
-            new_patient = Patient(distances, doses,
-                                  ids[patient_index], group,
-                                  info, use_distances = use_distances)
+            new_patient = parsed_patients[patient_index]
+            group = new_patient.group
             patients[patient_index] = new_patient
             classes[patient_index] = group
             laterality_list.append(new_patient.laterality)
@@ -188,6 +206,201 @@ class PatientSet():
         self.subsites = np.array(subsite_list)
         self.ids = np.array(ids)
         self.gtvs = gtv_list
+        if self.cache_dir is not None:
+            self.save_cache(cache_file)
+
+    def parse_patients(self, distance_files, dose_files, ids, metadata, use_distances, n_jobs = 1):
+        #reads the csv files into a list of patient objects in the same order as ids
+        #each patient is independent so with n_jobs > 1 they are parsed in a process pool
+        tasks = [(distance_files[i], dose_files[i], ids[i], metadata.loc[ids[i]], use_distances)
+                 for i in range(len(ids))]
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+        if n_jobs is None or n_jobs <= 1 or len(tasks) < 2:
+            return [self.parse_patient(*task) for task in tasks]
+        chunksize = max([1, len(tasks)//(4*n_jobs)])
+        with ProcessPoolExecutor(max_workers = n_jobs) as pool:
+            results = list(pool.map(self.parse_patient_logged, tasks, chunksize = chunksize))
+        patients = []
+        for (new_patient, no_tumor, missing_organs) in results:
+            #the patient class logs problems to Constants, which doesn't carry over from the workers
+            Constants.no_tumor.extend(no_tumor)
+            Constants.missing_organs.update(missing_organs)
+            patients.append(new_patient)
+        return patients
+
+    def parse_patient_logged(self, task):
+        #version of parse_patient used in worker processes, also returns what was added to the Constants logs
+        n_no_tumor = len(Constants.no_tumor)
+        old_missing_organs = set(Constants.missing_organs.keys())
+        new_patient = self.parse_patient(*task)
+        missing_organs = {k: v for k,v in Constants.missing_organs.items() if k not in old_missing_organs}
+        return (new_patient, Constants.no_tumor[n_no_tumor:], missing_organs)
+
+    def parse_patient(self, distance_file, dose_file, patient_id, info, use_distances):
+        dataset_version = int(findall('patients_v([0-9])', distance_file)[0])
+        assert(dataset_version in [2,3])
+        #these are indexed by name of organ
+        #we only use 3 rows but half of them have a comma missing in the header between the last two rows
+        distances = pd.read_csv(distance_file,
+                                usecols = [0,1,2]).dropna()
+        #renames anything that is equivalent to GTVp/GTVn to the correct format
+        distances = self.fix_tumor_names(distances)
+        doses = pd.read_csv(dose_file,
+                            usecols = [0,1,2,3,4,5,6,7]).dropna()
+        #pateints_v3 dataset has a different way of ording the columns (and different spelling)
+        if dataset_version == 2:
+            doses.columns = Constants.centroid_file_names_v2
+        elif dataset_version == 3:
+            doses.columns = Constants.centroid_file_names_v3
+        doses = self.fix_tumor_names(doses)
+        #misc patient info - laterality, subsite, total dose, etc is in info
+        group = self.get_patient_class(patient_id, doses.set_index('ROI').mean_dose)
+        #uses a new patient class to acually parse/process data
+        new_patient = Patient(distances, doses,
+                              patient_id, group,
+                              info, use_distances = use_distances)
+        return new_patient
+
+    def get_cache_file(self, files, use_distances):
+        #cache files are named using a hash of the paths and modification times of the input files
+        #so editing, adding, or removing a patient file will give a new cache file
+        file_hash = hashlib.sha1()
+        file_hash.update(str((PatientSet.cache_version, bool(use_distances))).encode())
+        for file in files:
+            try:
+                stats = os.stat(file)
+                file_hash.update(str((file, stats.st_mtime_ns, stats.st_size)).encode())
+            except OSError:
+                file_hash.update(str((file, None)).encode())
+        return os.path.join(self.cache_dir, 'patientset_' + file_hash.hexdigest()[:16] + '.npz')
+
+    def save_cache(self, cache_file):
+        #saves all the parsed arrays into a single .npz file. gtvs are flattened into one row per tumor
+        #with gtv_counts giving the number of tumors for each patient
+        arrays = {attr: getattr(self, attr) for attr in PatientSet.cache_attributes}
+        all_gtvs = [gtv for gtvset in self.gtvs for gtv in gtvset]
+        arrays['gtv_counts'] = np.array([len(gtvset) for gtvset in self.gtvs])
+        arrays['gtv_names'] = np.array([gtv.name for gtv in all_gtvs]).astype(str)
+        arrays['gtv_volumes'] = np.array([gtv.volume for gtv in all_gtvs]).astype('float64')
+        arrays['gtv_positions'] = np.array([np.asarray(gtv.position, dtype = 'float64') for gtv in all_gtvs]).reshape(-1, 3)
+        arrays['gtv_doses'] = np.array([np.asarray(gtv.doses, dtype = 'float64') for gtv in all_gtvs]).reshape(-1, 3)
+        arrays['gtv_dists'] = np.array([gtv.dists for gtv in all_gtvs]).reshape(-1, Constants.num_organs)
+        arrays['gtv_organs'] = np.array([gtv.organ for gtv in all_gtvs]).astype(str)
+        if self.all_organ_distances is not None:
+            arrays['all_organ_distances'] = self.all_organ_distances
+        try:
+            os.makedirs(self.cache_dir, exist_ok = True)
+            #write to a temporary file first so an interrupted run doesn't leave a broken cache
+            temp_file = cache_file + '.tmp.npz'
+            np.savez(temp_file, **arrays)
+            os.replace(temp_file, cache_file)
+        except OSError:
+            print('error saving patient data cache to ', cache_file)
+
+    def load_cache(self, cache_file, use_distances, lazy = False):
+        #loads the arrays saved by save_cache. returns False if the file can't be read
+        #if lazy, the arrays are left in the file and loaded by __getattr__ when they're first used
+        try:
+            with np.load(cache_file, allow_pickle = False) as cache:
+                if lazy:
+                    missing = [attr for attr in PatientSet.cache_attributes if attr not in cache.files]
+                    if len(missing) > 0:
+                        raise KeyError(missing)
+                    arrays = {}
+                else:
+                    arrays = {key: cache[key] for key in cache.files}
+        except Exception:
+            print('error reading patient data cache from ', cache_file)
+            return False
+        if lazy:
+            #everything stays in the file until it's used, see __getattr__
+            lazy_attributes = PatientSet.cache_attributes + ['gtvs']
+            if use_distances:
+                lazy_attributes = lazy_attributes + ['all_organ_distances']
+            for attr in lazy_attributes:
+                self.__dict__.pop(attr, None)
+            columns = {attr: [None, None] for attr in lazy_attributes}
+            if use_distances:
+                #not a per-patient column, it's just computed from the file on first use
+                columns['organ_distances'] = [None, None]
+            self.columns = columns
+            self.lazy_file = cache_file
+        else:
+            for attr in PatientSet.cache_attributes:
+                setattr(self, attr, arrays[attr])
+            self.gtvs = self.get_cached_gtvs(arrays)
+            if use_distances:
+                self.all_organ_distances = arrays['all_organ_distances']
+                self.organ_distances = self.all_organ_distances.mean(axis = 2)
+        if not use_distances:
+            self.organ_distances = self.load_saved_distances()
+            self.all_organ_distances = None
+        return True
+
+    def get_cached_gtvs(self, arrays, patients = None):
+        #rebuilds the gtv lists from the flattened arrays in the cache, for all patients or a list of positions
+        counts = arrays['gtv_counts']
+        starts = np.append(0, np.cumsum(counts)[:-1])
+        if patients is None:
+            patients = range(len(counts))
+        gtvs = []
+        for p in patients:
+            gtvset = []
+            for t in range(starts[p], starts[p] + counts[p]):
+                gtvset.append(GTV(str(arrays['gtv_names'][t]),
+                                  arrays['gtv_volumes'][t],
+                                  arrays['gtv_positions'][t],
+                                  arrays['gtv_doses'][t],
+                                  arrays['gtv_dists'][t],
+                                  str(arrays['gtv_organs'][t])))
+            gtvs.append(gtvset)
+        return gtvs
+
+    def register_columns(self):
+        #moves the per-patient attributes into self.columns so they can be subset without copying
+        columns = dict(self.columns)
+        for attr in PatientSet.patient_columns:
+            if self.__dict__.get(attr) is not None:
+                columns[attr] = [self.__dict__.pop(attr), None]
+        self.columns = columns
+
+    def __getattr__(self, name):
+        #only called when an attribute isn't set.  Columns are made from their base array and index
+        #(or loaded from the cache file in lazy mode) the first time they're used, and then kept as a normal attribute
+        columns = self.__dict__.get('columns')
+        if columns is None or name not in columns:
+            raise AttributeError(name)
+        value = self.get_column(name, *columns[name])
+        #replace instead of changing the dict, since copies of the patientset can share it
+        self.columns = {attr: column for attr, column in columns.items() if attr != name}
+        setattr(self, name, value)
+        return value
+
+    def get_column(self, name, base, index):
+        axis = PatientSet.patient_columns.get(name)
+        if base is None:
+            if name == 'gtvs':
+                return self.load_lazy_gtvs(index)
+            base = self.load_lazy_column(name)
+        if index is None or axis is None:
+            return base
+        if axis == 'list':
+            return [base[i] for i in index]
+        return np.take(base, index, axis = axis)
+
+    def load_lazy_column(self, name):
+        with np.load(self.lazy_file, allow_pickle = False) as cache:
+            if name == 'organ_distances':
+                #not changed by subset, like when everything is loaded at once
+                return cache['all_organ_distances'].mean(axis = 2)
+            return cache[name]
+
+    def load_lazy_gtvs(self, index):
+        #only makes the gtvs for the patients in the index
+        with np.load(self.lazy_file, allow_pickle = False) as cache:
+            gtv_arrays = {key: cache[key] for key in cache.files if key.startswith('gtv_')}
+        return self.get_cached_gtvs(gtv_arrays, index)
 
     def clean_values(self):
         #subsets to the values approved by the error checker object
@@ -199,45 +412,35 @@ class PatientSet():
     def subset(self, p):
         #take of list of indices and just subsets all the data to match
         #used when getting the error checker output for cleaning
-        #if new values are added, make sure to add them in here
-        self.doses = self.doses[p]
-        self.max_doses = self.max_doses[p]
-        self.min_doses = self.min_doses[p]
-        self.tumor_distances = self.tumor_distances[p]
-        self.volumes = self.volumes[p]
-        self.classes = self.classes[p]
-        self.prescribed_doses = self.prescribed_doses[p]
-        self.centroids = self.centroids[p]
-        self.lateralities = self.lateralities[p]
-        self.subsites = self.subsites[p]
-        self.lymph_nodes = self.lymph_nodes[p]
-        self.ids = self.ids[p]
-        new_gtvs = []
-        for patient in p:
-            new_gtvs.append(self.gtvs[patient])
-        self.gtvs = new_gtvs
-
-        self.ages = self.ages[p]
-        self.genders = self.genders[p]
-        self.t_categories = self.t_categories[p]
-        self.n_categories = self.n_categories[p]
-        self.therapy_type = self.therapy_type[p]
-        self.ajcc8 = self.ajcc8[p]
-        self.pathological_grades = self.pathological_grades[p]
-        self.hpv = self.hpv[p]
-        self.feeding_tubes = self.feeding_tubes[p]
-        self.dose_fractions = self.dose_fractions[p]
-        self.aspiration = self.aspiration[p]
-        self.aspiration_change = self.aspiration_change[p]
-
-        self.mean_tumor_distances = self.mean_tumor_distances[p]
-        self.max_tumor_distances = self.max_tumor_distances[p]
-        self.packs_per_year = self.packs_per_year[p]
-        self.smoking = self.smoking[p]
-
-        self.has_gtvp = self.has_gtvp[p]
-        if self.all_organ_distances is not None:
-            self.all_organ_distances = self.all_organ_distances[:,:,p]
+        #if new values are added, make sure to add them to cache_attributes or patient_columns
+        #this only updates the index of each column, the data is copied when a column is next used.
+        #p can also be a boolean mask over the patients
+        p = np.flatnonzero(p) if np.asarray(p).dtype == bool else np.asarray(p, dtype = 'int64').ravel()
+        new_indices = {}
+        def compose(index):
+            #columns subset together share an index, so each one is only composed once
+            if index is None:
+                return p
+            if id(index) not in new_indices:
+                new_indices[id(index)] = index[p]
+            return new_indices[id(index)]
+        columns = {}
+        for attr, (base, index) in self.columns.items():
+            if PatientSet.patient_columns.get(attr) is None:
+                columns[attr] = [base, index]
+            else:
+                columns[attr] = [base, compose(index)]
+        for attr in PatientSet.patient_columns:
+            if self.__dict__.get(attr) is not None:
+                columns[attr] = [self.__dict__.pop(attr), p]
+        self.columns = columns
+
+    def get_subset(self, p):
+        #a new patientset with only the patients in p. The columns are shared with this one
+        #until they're used, so it's cheap to make lots of them (e.g. for cross validation folds)
+        db = copy(self)
+        db.subset(p)
+        return db
 
     def get_num_patients(self):
         return( self.doses.shape[0] )
@@ -364,27 +567,66 @@ class PatientSet():
         distances = np.array(distances)
         return distances
 
-    def denoise_tumor_distances(self):
+    def denoise_tumor_distances(self, use_cache = False, noise = .5, lr = .0001,
+                                epochs = 800, batch_size = 4):
         #passes tumors through a densoiing autoencoder.
         #will change self.tumor_distance but not self.gtvs
+        #with use_cache, the denoiser weights and output are saved and reused for the same distances and settings
         distances = self.get_all_tumor_distances()
-        distances = Denoiser(normalize = False, noise = .5).fit_transform(distances, lr = .0001)
-        i = 0
-        #p = 0
-        new_tumor_distances = np.zeros(self.tumor_distances.shape)
-        all_tumor_distances = []
-        for p in range(self.get_num_patients()):
-            p_dists = []
-            count = len(self.gtvs[p])
-            new_dists = np.inf*np.ones((self.tumor_distances.shape[1]))
-            for c in range(count):
-                p_dists.append(distances[i])
-                new_dists = np.minimum(new_dists, distances[i])
-                i += 1
-            new_tumor_distances[p,:] = new_dists
-            all_tumor_distances.append( np.vstack(p_dists))
+        settings = {'noise': noise, 'lr': lr, 'epochs': epochs, 'batch_size': batch_size}
+        denoiser = None
+        if use_cache:
+            cache_file = self.get_denoiser_cache_file(distances, settings)
+            denoiser, denoised = self.load_denoiser_cache(cache_file)
+        if denoiser is None:
+            denoiser = Denoiser(normalize = False, noise = noise)
+            denoised = denoiser.fit_transform(distances, lr = lr, epochs = epochs, batch_size = batch_size)
+            if use_cache:
+                self.save_denoiser_cache(cache_file, denoiser, denoised)
+        self.denoiser = denoiser
+        #each patient's tumor distances are the min over all of their tumors
+        counts = np.array([len(gtvset) for gtvset in self.gtvs])
+        starts = np.append(0, np.cumsum(counts)[:-1])
+        new_tumor_distances = np.inf*np.ones(self.tumor_distances.shape)
+        has_tumors = counts > 0
+        if has_tumors.any():
+            new_tumor_distances[has_tumors] = np.minimum.reduceat(denoised, starts[has_tumors], axis = 0)
         self.tumor_distances = new_tumor_distances
-        self.stack_tumor_distances  = all_tumor_distances
+        self.stack_tumor_distances = np.split(denoised, starts[1:])
+
+    def get_denoiser_cache_file(self, distances, settings):
+        #named using a hash of the tumor distances and the denoiser settings
+        cache_dir = self.cache_dir if self.cache_dir is not None else os.path.join('data', 'cache')
+        distances = np.ascontiguousarray(distances, dtype = 'float64')
+        file_hash = hashlib.sha1(distances.tobytes())
+        file_hash.update(str((PatientSet.cache_version, distances.shape, sorted(settings.items()))).encode())
+        return os.path.join(cache_dir, 'denoiser_' + file_hash.hexdigest()[:16] + '.npz')
+
+    def save_denoiser_cache(self, cache_file, denoiser, denoised):
+        arrays = {'weights_' + str(i): w for i, w in enumerate(denoiser.weights)}
+        arrays['denoised'] = denoised
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok = True)
+            temp_file = cache_file + '.tmp.npz'
+            np.savez(temp_file, **arrays)
+            os.replace(temp_file, cache_file)
+        except OSError:
+            print('error saving denoiser cache to ', cache_file)
+
+    def load_denoiser_cache(self, cache_file):
+        #returns the denoiser with the saved weights and the denoised distances, or (None, None) if there isn't one
+        if not os.path.exists(cache_file):
+            return None, None
+        try:
+            with np.load(cache_file, allow_pickle = False) as cache:
+                weights = [cache['weights_' + str(i)] for i in range(4)]
+                denoised = cache['denoised']
+        except Exception:
+            print('error reading denoiser cache from ', cache_file)
+            return None, None
+        denoiser = Denoiser(normalize = False)
+        denoiser.weights = weights
+        return denoiser, denoised
 
     def tumorcount_patients(self, min_tumors = 3):
         #gets all patients with more than a given number of tumors
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+Keeps the augmented tanimoto similarity from analysis.default_similarity around so new patients
+can be added (or removed) by only computing their row of the matrix, instead of the whole thing.
+ApproximateSimilarityIndex does top-k lookups without the full matrix for bigger cohorts
+"""
+import pickle
+import numpy as np
+import Metrics
+from sklearn.preprocessing import KBinsDiscretizer
+from NeighborGraph import NeighborGraph
+
+class SimilarityIndex():
+    #stores the similarity of every pair of patients as two (n x n) matrices:
+    #normal[i,j] compares patients i and j, flipped[i,j] compares patient i with the mirrored version of patient j.
+    #the augmented (2n x 2n) matrix from default_similarity is [[normal, flipped], [flipped, normal]] after scaling
+    #patients are kept in "slots" in the order they are added, removed patients just have their slot turned off
+
+    def __init__(self, n_bins = 10, strategy = 'kmeans', organ_list = None, initial_capacity = 64):
+        self.n_bins = n_bins
+        self.strategy = strategy
+        self.flip_args = Metrics.get_flip_args(organ_list)
+        self.discretizer = None
+        self.capacity = 0
+        self.size = 0
+        self.ids = []
+        self.slots = {}
+        self.allocate(initial_capacity, len(self.flip_args))
+
+    def allocate(self, capacity, n_features):
+        #grows the storage arrays, keeping whatever is already in the filled slots
+        old_size = self.size
+        normal = np.zeros((capacity, capacity))
+        flipped = np.zeros((capacity, capacity))
+        features = np.zeros((capacity, n_features))
+        active = np.zeros((capacity,)).astype('bool')
+        if old_size > 0:
+            normal[:old_size, :old_size] = self.normal[:old_size, :old_size]
+            flipped[:old_size, :old_size] = self.flipped[:old_size, :old_size]
+            features[:old_size] = self.features[:old_size]
+            active[:old_size] = self.active[:old_size]
+        self.normal = normal
+        self.flipped = flipped
+        self.features = features
+        self.active = active
+        self.capacity = capacity
+
+    def fit(self, db):
+        #discretizes the tumor distances like default_similarity and fills in the matrices for the whole patientset
+        self.discretizer = KBinsDiscretizer(n_bins = self.n_bins,
+                                            encode = 'ordinal',
+                                            strategy = self.strategy)
+        features = self.discretizer.fit_transform(-db.tumor_distances)
+        n_patients = features.shape[0]
+        self.size = 0
+        self.ids = []
+        self.slots = {}
+        self.allocate(max([n_patients, 1]), features.shape[1])
+        self.features[:n_patients] = features
+        normal = Metrics.pairwise_sim(features, metric = 'jaccard')
+        flipped = Metrics.pairwise_sim(features, features[:, self.flip_args], metric = 'jaccard')
+        #patients aren't compared to themselves or their own mirror
+        diagonal = (np.arange(n_patients), np.arange(n_patients))
+        normal[diagonal] = 0
+        flipped[diagonal] = 0
+        self.normal[:n_patients, :n_patients] = normal
+        self.flipped[:n_patients, :n_patients] = flipped
+        self.active[:n_patients] = True
+        for p in range(n_patients):
+            self.ids.append(db.ids[p])
+            self.slots[db.ids[p]] = p
+        self.size = n_patients
+        self.update_range()
+        return self
+
+    def update_range(self):
+        #gets the min and max scores used for the minmax scaling.  The zeroed self-comparisons are included
+        #like in augmented_sim
+        args = self.get_active_slots()
+        if len(args) == 0:
+            self.min_score = 0
+            self.max_score = 0
+            return
+        normal = self.normal[np.ix_(args, args)]
+        flipped = self.flipped[np.ix_(args, args)]
+        self.min_score = min([normal.min(), flipped.min()])
+        self.max_score = max([normal.max(), flipped.max()])
+
+    def get_active_slots(self):
+        return np.argwhere(self.active[:self.size]).ravel()
+
+    def get_ids(self):
+        #ids of the current patients, in the same order as the rows of get_similarity
+        return np.array([self.ids[slot] for slot in self.get_active_slots()])
+
+    def get_num_patients(self):
+        return len(self.get_active_slots())
+
+    def transform(self, tumor_distances):
+        #discretizes new tumor distances with the bins fitted on the original patients
+        tumor_distances = np.asarray(tumor_distances, dtype = 'float64').reshape(-1, self.features.shape[1])
+        return self.discretizer.transform(-tumor_distances)
+
+    def get_raw_scores(self, features):
+        #unscaled similarity of discretized patients against every filled slot, for both orientations
+        stored_features = self.features[:self.size]
+        normal = Metrics.pairwise_sim(features, stored_features, metric = 'jaccard')
+        flipped = Metrics.pairwise_sim(features, stored_features[:, self.flip_args], metric = 'jaccard')
+        return normal, flipped
+
+    def scale(self, scores):
+        score_range = self.max_score - self.min_score
+        if score_range <= 0:
+            return np.zeros(np.shape(scores))
+        return (scores - self.min_score)/score_range
+
+    def query(self, tumor_distances):
+        #scores for new patients against the current ones without adding them.
+        #returns an (n_queries x 2n) array with the same column order as get_similarity
+        features = self.transform(tumor_distances)
+        normal, flipped = self.get_raw_scores(features)
+        args = self.get_active_slots()
+        return self.scale(np.hstack([normal[:, args], flipped[:, args]]))
+
+    def add_patient(self, patient_id, tumor_distances):
+        #adds a new patient, only computing its own row (and column) of the similarity matrices
+        if patient_id in self.slots:
+            print('patient ', patient_id, ' is already in the similarity index')
+            return
+        features = self.transform(tumor_distances)
+        if self.size >= self.capacity:
+            self.allocate(2*self.capacity, self.features.shape[1])
+        normal, flipped = self.get_raw_scores(features)
+        slot = self.size
+        self.features[slot] = features[0]
+        self.normal[slot, :slot] = normal[0]
+        self.normal[:slot, slot] = normal[0]
+        self.flipped[slot, :slot] = flipped[0]
+        self.flipped[:slot, slot] = flipped[0]
+        self.normal[slot, slot] = 0
+        self.flipped[slot, slot] = 0
+        self.active[slot] = True
+        self.ids.append(patient_id)
+        self.slots[patient_id] = slot
+        self.size += 1
+        args = self.get_active_slots()
+        new_scores = np.hstack([self.normal[slot, args], self.flipped[slot, args]])
+        self.min_score = min([self.min_score, new_scores.min()])
+        self.max_score = max([self.max_score, new_scores.max()])
+
+    def remove_patient(self, patient_id):
+        slot = self.slots.pop(patient_id, None)
+        if slot is None:
+            print('patient ', patient_id, ' is not in the similarity index')
+            return
+        args = self.get_active_slots()
+        old_scores = np.hstack([self.normal[slot, args], self.flipped[slot, args]])
+        self.active[slot] = False
+        #only need to look at the whole matrix again if this patient had the highest or lowest score
+        if old_scores.max() >= self.max_score or old_scores.min() <= self.min_score:
+            self.update_range()
+
+    def get_scores(self, patient_id):
+        #scaled row of the augmented similarity matrix for a patient already in the index
+        slot = self.slots[patient_id]
+        args = self.get_active_slots()
+        scores = self.scale(np.hstack([self.normal[slot, args], self.flipped[slot, args]]))
+        #a patient's score with itself is set to 0 after scaling, like augmented_sim
+        scores[np.argwhere(args == slot).ravel()] = 0
+        return scores
+
+    def get_similarity(self):
+        #full (2n x 2n) augmented similarity matrix, the same as default_similarity on the current patients
+        args = self.get_active_slots()
+        normal = self.normal[np.ix_(args, args)]
+        flipped = self.flipped[np.ix_(args, args)]
+        similarity = self.scale(np.block([[normal, flipped], [flipped, normal]]))
+        n_patients = len(args)
+        similarity[np.arange(n_patients), np.arange(n_patients)] = 0
+        return similarity
+
+    def save(self, file):
+        with open(file, 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(file):
+        with open(file, 'rb') as f:
+            return pickle.load(f)
+
+class ApproximateSimilarityIndex():
+    #approximate version for big cohorts that never makes the (n x n) matrices.
+    #uses random hyperplane (simhash) codes of the discretized tumor distances in n_tables hash tables,
+    #so a query only looks at the patients that share a bucket with it (or with its mirrored version) in some table,
+    #and then reranks those candidates with the exact tanimoto score.
+    #scores are the unscaled tanimoto similarity, flipped marks matches with the mirrored patient.
+    #more bits per code means smaller buckets, so fewer candidates are scored but more true matches are missed,
+    #and more tables (or n_probes = 1) gets that recall back for a few more candidates.
+    #for a fixed n_bits the fraction of the cohort scored stays about the same as it grows, so by default
+    #n_bits grows with log2(n patients). On clustered synthetic data, 16 tables and one probe gave (k = 10):
+    #   4000 patients, 12 bits: 0.999 recall scoring 14% of the cohort
+    #   16000 patients, 14 bits: 0.996 recall scoring 6%
+    #use get_recall and get_candidate_fraction to check the settings on real data
+
+    def __init__(self, n_tables = 16, n_bits = None, n_probes = 1, n_bins = 10,
+                 strategy = 'kmeans', organ_list = None, random_state = 0):
+        #n_probes is how many bits can be different in a code and still be looked at (0 or 1).
+        #n_bits = None uses max(8, round(log2(n patients))) when the index is fit
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.n_probes = n_probes
+        self.n_bins = n_bins
+        self.strategy = strategy
+        self.random_state = random_state
+        self.flip_args = Metrics.get_flip_args(organ_list)
+        self.discretizer = None
+        self.ids = []
+        self.slots = {}
+        self.tables = []
+
+    def fit(self, db):
+        self.discretizer = KBinsDiscretizer(n_bins = self.n_bins,
+                                            encode = 'ordinal',
+                                            strategy = self.strategy)
+        features = self.discretizer.fit_transform(-db.tumor_distances)
+        return self.fit_features(features, db.ids)
+
+    def fit_features(self, features, ids = None):
+        #builds the hash tables from already discretized features
+        features = np.asarray(features, dtype = 'float64')
+        n_patients, n_features = features.shape
+        n_bits = self.n_bits
+        if n_bits is None:
+            n_bits = max([8, int(np.round(np.log2(max([n_patients, 1]))))])
+        random = np.random.RandomState(self.random_state)
+        self.planes = random.normal(size = (n_features, self.n_tables*n_bits))
+        self.center = features.mean(axis = 0)
+        self.bit_values = 2**np.arange(n_bits).astype('int64')
+        self.features = features
+        self.ids = list(range(n_patients)) if ids is None else list(ids)
+        self.slots = {patient_id: p for p, patient_id in enumerate(self.ids)}
+        #each table maps a code to the array of patients with it
+        self.tables = []
+        codes = self.get_codes(features)
+        for t in range(self.n_tables):
+            table_codes, inverse = np.unique(codes[:, t], return_inverse = True)
+            buckets = np.split(np.argsort(inverse, kind = 'stable'), np.cumsum(np.bincount(inverse))[:-1])
+            self.tables.append(dict(zip(table_codes.tolist(), buckets)))
+        return self
+
+    def transform(self, tumor_distances):
+        tumor_distances = np.asarray(tumor_distances, dtype = 'float64').reshape(-1, self.features.shape[1])
+        return self.discretizer.transform(-tumor_distances)
+
+    def get_num_patients(self):
+        return self.features.shape[0]
+
+    def get_codes(self, features):
+        #(n x n_tables) integer codes from which side of each hyperplane the features are on
+        signs = (np.dot(features - self.center, self.planes) > 0).astype('int64')
+        signs = signs.reshape(signs.shape[0], self.n_tables, len(self.bit_values))
+        return np.dot(signs, self.bit_values)
+
+    def get_probe_codes(self, code):
+        if self.n_probes < 1:
+            return [code]
+        return [code] + [code ^ bit for bit in self.bit_values.tolist()]
+
+    def get_candidates(self, feature):
+        #patients that share a bucket with the feature or its mirrored version in any table
+        codes = self.get_codes(np.vstack([feature, feature[self.flip_args]]))
+        buckets = [np.zeros((0,)).astype('int64')]
+        for t in range(self.n_tables):
+            for code in codes[:, t]:
+                for probe in self.get_probe_codes(code):
+                    if probe in self.tables[t]:
+                        buckets.append(self.tables[t][probe])
+        return np.unique(np.concatenate(buckets))
+
+    def get_candidate_fraction(self, n_queries = 100):
+        #average fraction of the cohort that gets scored for a query, using the first n_queries patients
+        n_queries = min([n_queries, self.get_num_patients()])
+        counts = [len(self.get_candidates(self.features[p])) for p in range(n_queries)]
+        return np.mean(counts)/self.get_num_patients()
+
+    def rerank(self, feature, candidates, k):
+        #exact tanimoto scores for the candidates, best orientation for each, sorted by score and then position
+        feature = feature.reshape(1,-1)
+        normal = Metrics.pairwise_sim(feature, self.features[candidates], metric = 'jaccard')[0]
+        flipped = Metrics.pairwise_sim(feature[:, self.flip_args], self.features[candidates], metric = 'jaccard')[0]
+        is_flipped = flipped > normal
+        scores = np.maximum(normal, flipped)
+        order = np.lexsort((candidates, -scores))[:k]
+        return candidates[order], scores[order], is_flipped[order]
+
+    def query_features(self, feature, k = 10, exclude = None):
+        candidates = self.get_candidates(feature)
+        if exclude is not None:
+            candidates = candidates[candidates != exclude]
+        return self.rerank(np.asarray(feature, dtype = 'float64'), candidates, k)
+
+    def query(self, tumor_distances, k = 10):
+        #top k patients for a new patient, as (positions, scores, flipped)
+        return self.query_features(self.transform(tumor_distances)[0], k)
+
+    def add_patient(self, patient_id, tumor_distances):
+        if patient_id in self.slots:
+            print('patient ', patient_id, ' is already in the similarity index')
+            return
+        feature = self.transform(tumor_distances)
+        slot = self.features.shape[0]
+        self.features = np.vstack([self.features, feature])
+        codes = self.get_codes(feature)[0]
+        for t in range(self.n_tables):
+            bucket = self.tables[t].get(codes[t], np.zeros((0,)).astype('int64'))
+            self.tables[t][codes[t]] = np.append(bucket, slot)
+        self.ids.append(patient_id)
+        self.slots[patient_id] = slot
+
+    def get_neighbor_graph(self, k = 10):
+        #top k matches for every patient in the index (not including themselves)
+        n_patients = self.get_num_patients()
+        indptr = [0]
+        neighbors = []
+        scores = []
+        flipped = []
+        for p in range(n_patients):
+            p_neighbors, p_scores, p_flipped = self.query_features(self.features[p], k, exclude = p)
+            neighbors.append(p_neighbors)
+            scores.append(p_scores)
+            flipped.append(p_flipped)
+            indptr.append(indptr[-1] + len(p_neighbors))
+        return NeighborGraph(indptr, np.hstack(neighbors), np.hstack(scores),
+                             np.hstack(flipped), np.array(self.ids))
+
+    def get_exact_similarity(self):
+        #(n x n) best-orientation tanimoto scores and flipped mask, only for checking the index on smaller sets
+        normal = Metrics.pairwise_sim(self.features, metric = 'jaccard')
+        flipped = Metrics.pairwise_sim(self.features[:, self.flip_args], self.features, metric = 'jaccard')
+        is_flipped = flipped > normal
+        similarity = np.maximum(normal, flipped)
+        np.fill_diagonal(similarity, -np.inf)
+        return similarity, is_flipped
+
+    def get_recall(self, k = 10, similarity = None):
+        #fraction of the exact top k matches that the index finds, averaged over patients.
+        #similarity can be an (n x n) or augmented matrix like augmented_sim, otherwise the exact tanimoto scores are used.
+        #matches that tie with the k-th exact score count as correct
+        n_patients = self.get_num_patients()
+        if similarity is None:
+            similarity = self.get_exact_similarity()[0]
+        else:
+            similarity = np.array(similarity, dtype = 'float64')[:n_patients]
+            if similarity.shape[1] > n_patients:
+                similarity = np.maximum(similarity[:, :n_patients], similarity[:, n_patients:2*n_patients])
+            np.fill_diagonal(similarity, -np.inf)
+        graph = self.get_neighbor_graph(k)
+        recall = np.zeros((n_patients,))
+        for p in range(n_patients):
+            kth_score = -np.sort(-similarity[p])[k - 1]
+            neighbors = graph.get_row(p)[0]
+            recall[p] = min([k, np.sum(similarity[p, neighbors] >= kth_score)])/k
+        return recall.mean()
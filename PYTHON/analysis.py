@@ -6,18 +6,18 @@ Created on Fri Mar  8 10:08:52 2019
 """
 from numpy.random import seed
 seed(1)
-from tensorflow.compat.v1 import set_random_seed
-set_random_seed(2)
 from PatientSet import PatientSet
 from ErrorChecker import ErrorChecker
 from Constants import Constants
 from Models import *
+from NeighborGraph import NeighborGraph
+from PatientEmbedding import PatientEmbedding
 import numpy as np
 import json
+import os
 import pandas as pd
 from collections import OrderedDict
 import matplotlib.pyplot as plt
-from copy import copy
 #import metric_learn
 from preprocessing import *
 from Metrics import *
@@ -35,7 +35,20 @@ def export(data_set = None,
 #           estimator = None,
 #           similarity = None,
 #           predicted_doses = None,
-           clusterer=None):
+           clusterer=None,
+           shard_dir = None,
+           organ_file = None,
+           neighbor_file = None,
+           n_neighbors = 50,
+           embedding_file = None):
+    #shard_dir writes an index file and one json file per patient there (see export_shards)
+    #instead of the single patient_data_file, so the whole dataset is never in memory at once
+    #organ_file saves the organ and tumor data as float32 arrays (see export_organ_columns)
+    #instead of the organData in each patient entry
+    #neighbor_file saves the top n_neighbors of each patient as a NeighborGraph instead of the full score_file
+    #(more if some patients need more matches). KnnEstimator.get_matches can read the saved file
+    #embedding_file saves the tsne and mds views as a PatientEmbedding.  If it already exists, those are reused
+    #and only the patients that aren't in it get placed, instead of refitting both
     if data_set is None:
         data_set = PatientSet(root = 'data\\patients_v*\\',
                 use_distances = False)
@@ -81,85 +94,53 @@ def export(data_set = None,
         where_flipped = np.where(similarity[:n_patients, n_patients:] > similarity[:n_patients, :n_patients])
         flipped[where_flipped] = -1
         similarity = np.maximum(similarity[:n_patients, :n_patients], similarity[:n_patients, n_patients:])
-    similar_patients = estimator.get_matches(similarity, data_set)
+    graph = None
+    if neighbor_file is not None:
+        #the graph needs enough neighbors that every patient still has all its matches after the outliers are removed
+        num_matches = estimator.get_all_num_matches(similarity, data_set.classes)
+        n_outliers = len(ErrorChecker().get_data_outliers(data_set.doses))
+        n_neighbors = max([n_neighbors, int(num_matches.max()) + n_outliers + 1])
+        graph = NeighborGraph.from_similarity(similarity, k = n_neighbors,
+                                              flipped = (flipped[:n_patients, :n_patients] < 0),
+                                              ids = data_set.ids)
+        similar_patients = estimator.get_matches(graph, data_set)
+    else:
+        similar_patients = estimator.get_matches(similarity, data_set)
     dose_pca = pca(data_set.doses)
-    distance_tsne = TSNE(perplexity = 60, init = 'pca').fit_transform(data_set.tumor_distances)
-    similarity_embedding = MDS(dissimilarity='precomputed', random_state = 1).fit_transform(disimilarity)
+    distance_tsne, similarity_embedding = get_embeddings(data_set, disimilarity, embedding_file)
     if clusterer is not None:
         clusters = clusterer.fit_predict(disimilarity).ravel()
         clusters = (clusters - clusters.min() + 1).astype('int32')
     else:
         clusters = data_set.classes
     clusters = clusters.astype('int32') - clusters.min() + 1
-    export_data = []
-    for x in range(data_set.get_num_patients()):
-        entry = OrderedDict()
-        entry['ID'] = data_set.ids[x]
-        entry['ID_internal'] = x+1
-        matches = similar_patients[x].tolist()
-        simsort_args = np.argsort(-similarity[x,:]).ravel()
-        local_similarity = similarity[x, simsort_args]*flipped[x, simsort_args]
-        entry['similarity_scores'] = (local_similarity[:len(matches)]).tolist()
-        entry['similar_patients'] = matches
-        entry['mean_error'] = round(error[x], 4)
-
-        entry['cluster'] = clusters[x]
-        entry['laterality'] = data_set.lateralities[x]
-        entry['tumorSubsite'] = data_set.subsites[x]
-        entry['total_Dose'] = int(data_set.prescribed_doses[x])
-        entry['dose_pca'] = dose_pca[x, :].tolist()
-        entry['distance_pca'] = distance_tsne[x, :].tolist()
-        entry['similarity_embedding'] = similarity_embedding[x,:].tolist()
-        entry['toxicity'] = 1 if (data_set.feeding_tubes[x] + data_set.aspiration[x]) > 0 else 0
-        organ_data = OrderedDict()
-        organ_centroids = data_set.centroids[x, :, :]
-        for idx in range(Constants.num_organs):
-            organ_entry = OrderedDict()
-            organ_name = Constants.organ_list[idx]
-            centroid = organ_centroids[idx, :]
-            organ_entry['x'] = centroid[0]
-            organ_entry['y'] = centroid[1]
-            organ_entry['z'] = centroid[2]
-            organ_entry['volume'] = data_set.volumes[x, idx]
-            organ_entry['meanDose'] = data_set.doses[x, idx]
-            organ_entry['minDose'] = data_set.min_doses[x, idx]
-            organ_entry['maxDose'] = data_set.max_doses[x, idx]
-            organ_entry['estimatedDose'] = predicted_doses[x, idx]
-            organ_data[organ_name] = organ_entry
-
-        tumors = data_set.gtvs[x]
-        tvols = [tumor.volume for tumor in tumors]
-        entry['tumorVolume'] = np.sum(tvols)
-        entry['gtvp_volume'] = tumors[0].volume
-        if len(tumors) > 1:
-            entry['gtvn_volume'] = np.sum(tvols[1:])
-        else:
-            entry['gtvn_volume'] = 0
-        for tumor_idx in range(len(tumors)):
-            tumor = tumors[tumor_idx]
-            tumor_entry = OrderedDict()
-            tumor_entry['x'] = tumor.position[0]
-            tumor_entry['y'] = tumor.position[1]
-            tumor_entry['z'] = tumor.position[2]
-            tumor_entry['volume'] = tumor.volume
-            tumor_entry['meanDose'] = tumor.doses[1]
-            tumor_entry['minDose'] = tumor.doses[0]
-            tumor_entry['maxDose'] = tumor.doses[2]
-            organ_data[tumor.name] = tumor_entry
-        entry['organData'] = organ_data
-        export_data.append(entry)
-        #save the vast dictionary of data for the front-end
-    try:
-        json.encoder.FLOAT_REPR = lambda o: format(o, '.2f')
-        def default(o):
-            if isinstance(o, np.int32):
-                return int(o)
-        with open(patient_data_file, 'w+') as f:  # generate JSON
-            json.dump( export_data, f, indent=4, default = default)
-        print('successfully save patient data to ', patient_data_file)
-        #save a labeled matrix of similarity scores for other people
-    except:
-        print('error exporting patient data to json')
+    export_info = {'similar_patients': similar_patients, 'similarity': similarity,
+                   'flipped': flipped, 'error': error, 'clusters': clusters,
+                   'dose_pca': dose_pca, 'distance_tsne': distance_tsne,
+                   'similarity_embedding': similarity_embedding,
+                   'predicted_doses': predicted_doses, 'graph': graph}
+    if organ_file is not None:
+        export_organ_columns(data_set, predicted_doses, organ_file)
+    entries = (get_export_entry(data_set, x, export_info, include_organs = (organ_file is None))
+               for x in range(n_patients))
+    if shard_dir is not None:
+        export_shards(entries, shard_dir)
+    else:
+        try:
+            export_data = list(entries)
+            with open(patient_data_file, 'w+') as f:  # generate JSON
+                json.dump( export_data, f, indent=4, default = export_default)
+            print('successfully save patient data to ', patient_data_file)
+            #save a labeled matrix of similarity scores for other people
+        except:
+            print('error exporting patient data to json')
+    if graph is not None:
+        try:
+            graph.save(neighbor_file)
+            print('successfully saved neighbor graph to ', neighbor_file)
+        except Exception as e:
+            print('error saving neighbor graph to ', neighbor_file, e)
+        return
     try:
         scaled_similarity = minmax_scale(similarity)
         for i in range(scaled_similarity.shape[0]):
@@ -171,26 +152,203 @@ def export(data_set = None,
         print('error saving ssim score matrix')
     return
 
+def export_default(o):
+    #json can't save numpy numbers or arrays on its own
+    if isinstance(o, np.integer):
+        return int(o)
+    if isinstance(o, np.floating):
+        return float(o)
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+
+def get_embeddings(data_set, disimilarity, embedding_file = None):
+    #tsne of the tumor distances and mds of the similarity for export
+    embedding = None
+    if embedding_file is not None and os.path.isfile(embedding_file):
+        try:
+            embedding = PatientEmbedding.load(embedding_file)
+        except Exception as e:
+            print('error loading embedding from ', embedding_file, e)
+    if embedding is not None and not (embedding.get_positions(data_set.ids) >= 0).any():
+        print('saved embedding has none of these patients, refitting it')
+        embedding = None
+    if embedding is None:
+        distance_tsne = TSNE(perplexity = 60, init = 'pca').fit_transform(data_set.tumor_distances)
+        similarity_embedding = MDS(dissimilarity='precomputed', random_state = 1).fit_transform(disimilarity)
+        if embedding_file is None:
+            return distance_tsne, similarity_embedding
+        embedding = PatientEmbedding(data_set.ids, data_set.tumor_distances,
+                                     distance_tsne, similarity_embedding)
+    else:
+        positions = embedding.get_positions(data_set.ids)
+        new = np.argwhere(positions < 0).ravel()
+        old = np.argwhere(positions >= 0).ravel()
+        if len(new) > 0:
+            print('adding ', len(new), ' patients to the saved embedding')
+            embedding.add_patients([data_set.ids[p] for p in new],
+                                   data_set.tumor_distances[new],
+                                   disimilarity[np.ix_(new, old)],
+                                   anchors = positions[old])
+    try:
+        embedding.save(embedding_file)
+    except Exception as e:
+        print('error saving embedding to ', embedding_file, e)
+    return embedding.get_tsne(data_set.ids), embedding.get_mds(data_set.ids)
+
+def get_export_entry(data_set, x, export_info, include_organs = True):
+    #the data for patient x used by the front end
+    #include_organs = False leaves out organData, for when it's saved with export_organ_columns
+    similarity = export_info['similarity']
+    predicted_doses = export_info['predicted_doses']
+    entry = OrderedDict()
+    entry['ID'] = data_set.ids[x]
+    entry['ID_internal'] = x+1
+    matches = export_info['similar_patients'][x].tolist()
+    if export_info.get('graph') is not None:
+        neighbors, scores, flipped = export_info['graph'].get_row(x)
+        local_similarity = scores*np.where(flipped, -1, 1)
+    else:
+        simsort_args = np.argsort(-similarity[x,:]).ravel()
+        local_similarity = similarity[x, simsort_args]*export_info['flipped'][x, simsort_args]
+    entry['similarity_scores'] = (local_similarity[:len(matches)]).tolist()
+    entry['similar_patients'] = matches
+    entry['mean_error'] = round(export_info['error'][x], 4)
+
+    entry['cluster'] = export_info['clusters'][x]
+    entry['laterality'] = data_set.lateralities[x]
+    entry['tumorSubsite'] = data_set.subsites[x]
+    entry['total_Dose'] = int(data_set.prescribed_doses[x])
+    entry['dose_pca'] = export_info['dose_pca'][x, :].tolist()
+    entry['distance_pca'] = export_info['distance_tsne'][x, :].tolist()
+    entry['similarity_embedding'] = export_info['similarity_embedding'][x,:].tolist()
+    entry['toxicity'] = 1 if (data_set.feeding_tubes[x] + data_set.aspiration[x]) > 0 else 0
+    tumors = data_set.gtvs[x]
+    tvols = [tumor.volume for tumor in tumors]
+    entry['tumorVolume'] = np.sum(tvols)
+    entry['gtvp_volume'] = tumors[0].volume
+    if len(tumors) > 1:
+        entry['gtvn_volume'] = np.sum(tvols[1:])
+    else:
+        entry['gtvn_volume'] = 0
+    if not include_organs:
+        return entry
+    organ_data = OrderedDict()
+    organ_centroids = data_set.centroids[x, :, :]
+    for idx in range(Constants.num_organs):
+        organ_entry = OrderedDict()
+        organ_name = Constants.organ_list[idx]
+        centroid = organ_centroids[idx, :]
+        organ_entry['x'] = centroid[0]
+        organ_entry['y'] = centroid[1]
+        organ_entry['z'] = centroid[2]
+        organ_entry['volume'] = data_set.volumes[x, idx]
+        organ_entry['meanDose'] = data_set.doses[x, idx]
+        organ_entry['minDose'] = data_set.min_doses[x, idx]
+        organ_entry['maxDose'] = data_set.max_doses[x, idx]
+        organ_entry['estimatedDose'] = predicted_doses[x, idx]
+        organ_data[organ_name] = organ_entry
+
+    for tumor_idx in range(len(tumors)):
+        tumor = tumors[tumor_idx]
+        tumor_entry = OrderedDict()
+        tumor_entry['x'] = tumor.position[0]
+        tumor_entry['y'] = tumor.position[1]
+        tumor_entry['z'] = tumor.position[2]
+        tumor_entry['volume'] = tumor.volume
+        tumor_entry['meanDose'] = tumor.doses[1]
+        tumor_entry['minDose'] = tumor.doses[0]
+        tumor_entry['maxDose'] = tumor.doses[2]
+        organ_data[tumor.name] = tumor_entry
+    entry['organData'] = organ_data
+    return entry
+
+#columns of the organ and tumor arrays saved by export_organ_columns
+organ_fields = ['x', 'y', 'z', 'volume', 'meanDose', 'minDose', 'maxDose', 'estimatedDose']
+tumor_fields = ['x', 'y', 'z', 'volume', 'meanDose', 'minDose', 'maxDose']
+
+def export_organ_columns(data_set, predicted_doses, organ_file):
+    #saves the organData for all patients as little endian float32 arrays in organ_file (a .bin):
+    #an (n_patients x n_organs x organ_fields) block followed by an (n_tumors x tumor_fields) block.
+    #organ_file + '.json' is a header with the shapes, byte offsets, field names, organ names, and which
+    #patient each tumor belongs to, so a browser can read the blocks straight into Float32Arrays
+    organ_data = np.stack([data_set.centroids[:,:,0],
+                           data_set.centroids[:,:,1],
+                           data_set.centroids[:,:,2],
+                           data_set.volumes,
+                           data_set.doses,
+                           data_set.min_doses,
+                           data_set.max_doses,
+                           predicted_doses], axis = 2).astype('<f4')
+    all_tumors = [tumor for tumors in data_set.gtvs for tumor in tumors]
+    tumor_data = np.array([[tumor.position[0], tumor.position[1], tumor.position[2],
+                            tumor.volume, tumor.doses[1], tumor.doses[0], tumor.doses[2]]
+                           for tumor in all_tumors], dtype = '<f4').reshape(-1, len(tumor_fields))
+    header = OrderedDict()
+    header['file'] = os.path.basename(organ_file)
+    header['dtype'] = 'float32'
+    header['byteorder'] = 'little'
+    header['ids'] = list(data_set.ids)
+    header['organs'] = list(Constants.organ_list)
+    header['organ_fields'] = organ_fields
+    header['organ_shape'] = list(organ_data.shape)
+    header['organ_offset'] = 0
+    header['tumor_fields'] = tumor_fields
+    header['tumor_shape'] = list(tumor_data.shape)
+    header['tumor_offset'] = organ_data.nbytes
+    #patient x has tumors tumor_starts[x] to tumor_starts[x+1]
+    header['tumor_starts'] = np.append(0, np.cumsum([len(tumors) for tumors in data_set.gtvs])).tolist()
+    header['tumor_names'] = [tumor.name for tumor in all_tumors]
+    try:
+        with open(organ_file, 'wb') as f:
+            f.write(organ_data.tobytes())
+            f.write(tumor_data.tobytes())
+        with open(organ_file + '.json', 'w') as f:
+            json.dump(header, f, separators = (',', ':'), default = export_default)
+        print('successfully saved organ data to ', organ_file)
+    except Exception as e:
+        print('error saving organ data to ', organ_file, e)
+
+#fields of each patient that go in the index file for sharded exports, everything else is only in the shards
+shard_index_fields = ['ID', 'ID_internal', 'cluster', 'laterality', 'tumorSubsite',
+                      'total_Dose', 'mean_error', 'toxicity', 'similar_patients',
+                      'dose_pca', 'distance_pca', 'similarity_embedding']
+
+def export_shards(entries, shard_dir, index_file = 'patient_index.json'):
+    #writes each patient entry to shard_dir/patients/<ID_internal>.json as soon as it's made,
+    #and streams a compact index (the fields in shard_index_fields + the shard path) to shard_dir/index_file.
+    #only one patient entry is in memory at a time
+    patient_dir = os.path.join(shard_dir, 'patients')
+    try:
+        os.makedirs(patient_dir, exist_ok = True)
+        n_patients = 0
+        with open(os.path.join(shard_dir, index_file), 'w') as index:
+            index.write('[')
+            for entry in entries:
+                shard = 'patients/' + str(entry['ID_internal']) + '.json'
+                with open(os.path.join(shard_dir, shard), 'w') as f:
+                    json.dump(entry, f, separators = (',', ':'), default = export_default)
+                index_entry = OrderedDict([(field, entry[field]) for field in shard_index_fields])
+                index_entry['shard'] = shard
+                if n_patients > 0:
+                    index.write(',\n')
+                index.write(json.dumps(index_entry, separators = (',', ':'), default = export_default))
+                n_patients += 1
+            index.write(']\n')
+        print('successfully saved', n_patients, 'patient shards to ', shard_dir)
+    except Exception as e:
+        print('error exporting patient shards to ', shard_dir, e)
+
 def threshold_grid_search(db, similarity, start_k = .4, max_matches = 20,
                           print_out = True, n_itters = 20, get_model = False):
-    best_score = 100 #this is percent error at time of writing this
-    best_threshold = 0
-    best_min_matches = 0
-    for k in np.linspace(start_k, 1, n_itters):
-        for m in range(1, max_matches):
-            result = KnnEstimator(match_threshold = k, min_matches = m).evaluate(similarity, db)
-            if result.mean() < best_score:
-                best_score = result.mean()
-                best_threshold = copy(k)
-                best_min_matches = copy(m)
+    tuner = ThresholdTuner(thresholds = np.linspace(start_k, 1, n_itters),
+                           min_matches = np.arange(1, max_matches)).fit(similarity, db)
     if print_out:
-        print('Score-', round(100*best_score,2) , ': Threshold-', round(best_threshold,2) , ': Min matches-', best_min_matches)
+        print('Score-', round(100*tuner.best_score,2) , ': Threshold-', round(tuner.best_threshold,2) ,
+              ': Min matches-', tuner.best_min_matches)
     if get_model:
-        return KnnEstimator(match_type = 'threshold',
-                            match_threshold = best_threshold,
-                            min_matches = best_min_matches)
+        return tuner.get_estimator()
     else:
-        return((best_score, best_threshold, best_min_matches))
+        return((tuner.best_score, tuner.best_threshold, tuner.best_min_matches))
 
 def tsim_similarity(db):
     return TsimModel().get_similarity(db, augment = True)
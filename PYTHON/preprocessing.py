@@ -7,12 +7,9 @@ Created on Wed Jun  5 17:43:34 2019
 #need to set random seeds before imports for consistent results?
 from numpy.random import seed
 seed(1)
-from tensorflow import set_random_seed
-set_random_seed(2)
+import numpy as np
 from Constants import Constants
-from keras.models import Sequential, Model
-from keras.layers import Dense, Activation
-from keras import losses, optimizers,regularizers, layers
+#tensorflow and keras are only imported if the keras backend is used, since importing them is slow
 
 class Normalizer():
 
@@ -35,11 +32,37 @@ class Normalizer():
         return x*self.std + self.mean
 
 class Denoiser():
+    #denoising autoencoder: gaussian dropout -> linear layer (2*n_features) -> gaussian noise -> linear layer (n_features)
+    #backend = 'numpy' trains it with adam in numpy, or 'keras' uses the original keras model.
+    #mode = 'closed_form' (numpy only) solves for the linear map that minimizes the expected loss over the dropout
+    #instead of training, the hidden noise is left out since the first layer can scale it away
 
-    def __init__(self, noise = 1, dropout = .1, n_features = None, normalize = True, verbose = 0):
+    def __init__(self, noise = 1, dropout = .1, n_features = None, normalize = True, verbose = 0,
+                 backend = 'numpy', mode = 'sgd', random_state = 2):
         if n_features is None:
             n_features = Constants.num_organs
         self.verbose = verbose
+        self.noise = noise
+        self.dropout = dropout
+        self.n_features = n_features
+        self.backend = backend
+        self.mode = mode
+        self.random_state = np.random.RandomState(random_state)
+        if backend == 'keras':
+            self.model = self.get_keras_model(noise, dropout, n_features, random_state)
+        else:
+            self.weights = self.get_initial_weights(n_features)
+        if normalize:
+            self.normalizer = Normalizer()
+        else:
+            self.normalizer = None
+
+    def get_keras_model(self, noise, dropout, n_features, random_state):
+        from tensorflow.compat.v1 import set_random_seed
+        set_random_seed(random_state)
+        from keras.models import Sequential, Model
+        from keras.layers import Dense
+        from keras import layers
         input_x = layers.Input(shape=(n_features,))
         encoder = Sequential([
                 layers.GaussianDropout(dropout),
@@ -47,33 +70,105 @@ class Denoiser():
                 layers.GaussianNoise(noise),
                 Dense(n_features, activation = 'linear'),
                 ])(input_x)
-        model = Model(input_x, encoder)
-        self.model = model
-        if normalize:
-            self.normalizer = Normalizer()
-        else:
-            self.normalizer = None
+        return Model(input_x, encoder)
+
+    def get_initial_weights(self, n_features):
+        #glorot uniform weights and zero biases, like the keras defaults
+        def glorot(fan_in, fan_out):
+            limit = np.sqrt(6/(fan_in + fan_out))
+            return self.random_state.uniform(-limit, limit, size = (fan_in, fan_out))
+        return [glorot(n_features, 2*n_features), np.zeros((2*n_features,)),
+                glorot(2*n_features, n_features), np.zeros((n_features,))]
 
     def fit(self, features, normalize = True, lr = .001,
                      epochs = 800, batch_size = 4):
-        optimizer = optimizers.Adam(lr=lr)
-        self.model.compile(loss = losses.mean_squared_error,
-                      optimizer = optimizer)
         if self.normalizer is not None:
             x = self.normalizer.fit_transform(features)
         else:
             x = features
-        self.model.fit(x,x,
-                       epochs = epochs,
-                       batch_size = batch_size,
-                       verbose = self.verbose)
+        if self.backend == 'keras':
+            from keras import losses, optimizers
+            optimizer = optimizers.Adam(lr=lr)
+            self.model.compile(loss = losses.mean_squared_error,
+                          optimizer = optimizer)
+            self.model.fit(x,x,
+                           epochs = epochs,
+                           batch_size = batch_size,
+                           verbose = self.verbose)
+        elif self.mode == 'closed_form':
+            self.fit_closed_form(x)
+        else:
+            self.fit_sgd(x, lr, epochs, batch_size)
+
+    def fit_sgd(self, x, lr, epochs, batch_size, beta1 = .9, beta2 = .999, epsilon = 1e-7):
+        #minibatch adam on the mean squared reconstruction error, with the dropout and noise only used in training.
+        #the weights are views into one flat array so each adam step is a few operations on the whole thing
+        x = np.asarray(x, dtype = 'float64')
+        params = np.concatenate([w.ravel() for w in self.weights])
+        gradient = np.zeros(params.shape)
+        splits = np.cumsum([w.size for w in self.weights])[:-1]
+        [w1, b1, w2, b2] = [p.reshape(w.shape) for p, w in zip(np.split(params, splits), self.weights)]
+        [g_w1, g_b1, g_w2, g_b2] = [g.reshape(w.shape) for g, w in zip(np.split(gradient, splits), self.weights)]
+        self.weights = [w1, b1, w2, b2]
+        dropout_std = np.sqrt(self.dropout/(1 - self.dropout))
+        moment = np.zeros(params.shape)
+        velocity = np.zeros(params.shape)
+        step = 0
+        for epoch in range(epochs):
+            x_shuffled = x[self.random_state.permutation(x.shape[0])]
+            #noise for the whole epoch at once
+            x_in = x_shuffled*self.random_state.normal(1, dropout_std, size = x.shape)
+            hidden_noise = self.random_state.normal(0, self.noise, size = (x.shape[0], w1.shape[1]))
+            epoch_loss = 0
+            for start in range(0, x.shape[0], batch_size):
+                x_batch = x_shuffled[start: start + batch_size]
+                x_in_batch = x_in[start: start + batch_size]
+                hidden = np.dot(x_in_batch, w1) + b1 + hidden_noise[start: start + batch_size]
+                error = np.dot(hidden, w2) + b2 - x_batch
+                d_out = (2/error.size)*error
+                d_hidden = np.dot(d_out, w2.T)
+                np.dot(x_in_batch.T, d_hidden, out = g_w1)
+                np.sum(d_hidden, axis = 0, out = g_b1)
+                np.dot(hidden.T, d_out, out = g_w2)
+                np.sum(d_out, axis = 0, out = g_b2)
+                step += 1
+                moment *= beta1
+                moment += (1 - beta1)*gradient
+                velocity *= beta2
+                velocity += (1 - beta2)*gradient**2
+                params -= (lr*np.sqrt(1 - beta2**step)/(1 - beta1**step))*moment/(np.sqrt(velocity) + epsilon)
+                if self.verbose:
+                    epoch_loss += np.mean(error**2)*x_batch.shape[0]
+            if self.verbose:
+                print('epoch', epoch + 1, 'loss', epoch_loss/x.shape[0])
+
+    def fit_closed_form(self, x):
+        #the expected squared error over the gaussian dropout is ||x - x*a - c||^2 + var*sum_j ||a_j||^2 * sum_i x_ij^2
+        #which is a ridge regression with a per-feature penalty, solved with the bias as an extra column
+        x = np.asarray(x, dtype = 'float64')
+        n_features = x.shape[1]
+        variance = self.dropout/(1 - self.dropout)
+        z = np.hstack([x, np.ones((x.shape[0], 1))])
+        penalty = np.append(variance*np.sum(x**2, axis = 0), 0)
+        gram = np.dot(z.T, z) + np.diag(penalty)
+        solution = np.linalg.lstsq(gram, np.dot(z.T, x), rcond = None)[0]
+        #stored as the same two layers so transform works the same way
+        w1 = np.hstack([solution[:n_features], np.zeros((n_features, n_features))])
+        w2 = np.vstack([np.eye(n_features), np.zeros((n_features, n_features))])
+        self.weights = [w1, np.zeros((2*n_features,)), w2, solution[n_features]]
+
+    def predict(self, x):
+        if self.backend == 'keras':
+            return self.model.predict(x)
+        [w1, b1, w2, b2] = self.weights
+        return np.dot(np.dot(x, w1) + b1, w2) + b2
 
     def transform(self, features, normalize = True):
         if self.normalizer is not None:
             x = self.normalizer.transform(features)
         else:
             x = features
-        y = self.model.predict(x)
+        y = self.predict(x)
         if self.normalizer is not None:
             y = self.normalizer.unnormalize(y)
         return y